@@ -0,0 +1,389 @@
+"""
+benchmarks of the hot paths, run with `python src/benchmark.py [group ...]`.
+every result is a cost, the lower the better. `--save results.json` keeps the results with the environment they were
+measured in, `--compare baseline.json` reports the change from an earlier run and exits with 1 if a result is worse
+than the baseline by more than `--threshold`
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict
+
+from config import config
+from storage import storage
+
+# the bot, its users and their repositories are built when `main` is imported:
+# give it a database and a storage of its own, so that the benchmarks never touch the data of the bot
+DATA_DIR = tempfile.TemporaryDirectory(prefix='bykc-bench-')
+config.override(db_path=os.path.join(DATA_DIR.name, 'db.sqlite3'))
+storage.path = os.path.join(DATA_DIR.name, 'storage.json')
+storage.data = {}
+
+import html_process
+import main
+from html_corpus import CORPUS, DESCRIPTIONS
+from client.client import decode_response
+from client.crypto import build_envelope, aes_encrypt, aes_decrypt, rsa_encrypt, sign, generate_aes_key
+from fake_bykc import FakeCourse
+from main import ReceivedCourseData, render_course_list
+from models import Base, Course, create_engines
+from offload import Offload
+from repository import CourseRepository
+from users import users
+
+SAMPLE_DESC = '<p><span style="font-family:宋体;font-size:16px"><span style="font-family:宋体">腾讯会议：</span></span>' \
+              '<strong><span style="font-family: 黑体;">324-195-464</span></strong></p>' * 40
+
+
+def measure(func, rounds: int, repeat: int = 3) -> float:
+    """
+    :return: cpu time in microseconds spent by one call of `func`, the best of `repeat` runs of `rounds` calls
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(rounds):
+            func()
+        elapsed = (time.process_time() - start) / rounds * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def catalog_page(size=20) -> dict:
+    """
+    a page of `queryStudentSemesterCourseByPage` as the server returns it
+    """
+    open_at = time.time() + 86400
+    return {'content': [FakeCourse(10000 + i, open_at).to_dict(time.time()) for i in range(size)],
+            'totalElements': size, 'totalPages': 1}
+
+
+def bench_crypto(rounds=2000) -> Dict[str, float]:
+    """
+    the primitives every api call goes through
+    """
+    message = json.dumps({'courseId': 12345}).encode()
+    page = json.dumps({'status': '0', 'errmsg': '', 'data': catalog_page()}).encode()
+    key = generate_aes_key()
+    encrypted_page = aes_encrypt(page, key)
+    return {
+        'crypto.generate_aes_key_us': measure(generate_aes_key, rounds),
+        'crypto.aes_encrypt_request_us': measure(lambda: aes_encrypt(message, key), rounds),
+        'crypto.aes_decrypt_page_us': measure(lambda: aes_decrypt(encrypted_page, key), rounds),
+        'crypto.sign_us': measure(lambda: sign(message), rounds),
+        'crypto.rsa_encrypt_us': measure(lambda: rsa_encrypt(key), rounds // 4),
+    }
+
+
+def bench_envelope(rounds=2000) -> Dict[str, float]:
+    """
+    cpu cost of one api call besides the network: the envelope built on the spot or taken from the pool,
+    and the response decoded
+    """
+    data_str = json.dumps({'courseId': 12345}).encode()
+    envelopes = [build_envelope(data_str) for _ in range(rounds * 3)]
+    key = envelopes[0].aes_key
+    response = base64.b64encode(aes_encrypt(json.dumps({'status': '0', 'data': {}}).encode(), key))
+    page = base64.b64encode(aes_encrypt(json.dumps({'status': '0', 'data': catalog_page()}).encode(), key))
+
+    def on_the_spot():
+        envelope = build_envelope(data_str)
+        return envelope.body, envelope.ak, envelope.sk, str(int(time.time() * 1000))
+
+    def prebuilt():
+        envelope = envelopes.pop()
+        return envelope.body, envelope.ak, envelope.sk, str(int(time.time() * 1000))
+
+    return {
+        'envelope.build_us': measure(on_the_spot, rounds // 4),
+        'envelope.pooled_us': measure(prebuilt, rounds),
+        'envelope.decode_response_us': measure(lambda: decode_response(response, key), rounds),
+        'envelope.decode_page_us': measure(lambda: decode_response(page, key), rounds),
+    }
+
+
+def check_html() -> bool:
+    """
+    every html engine must reproduce the golden outputs, and agree with the others on the real descriptions
+    """
+    ok = True
+    for name, engine in html_process.ENGINES.items():
+        for case, html, expected in CORPUS:
+            result = engine(html)
+            if result != expected:
+                ok = False
+                print(f"html engine {name} differs on '{case}': {result!r} != {expected!r}")
+        for i, html in enumerate(DESCRIPTIONS):
+            if engine(html) != html_process.transform_bs4(html):
+                ok = False
+                print(f"html engine {name} differs from bs4 on description {i}")
+    print(f"html golden corpus: {'ok' if ok else 'FAILED'}, {len(CORPUS)} cases, {len(DESCRIPTIONS)} descriptions")
+    return ok
+
+
+def bench_html(rounds=200) -> Dict[str, float]:
+    """
+    time to transform the real descriptions and a long one, and peak memory on the long one, per engine
+    """
+    results = {}
+    for name, engine in html_process.ENGINES.items():
+        results[f'html.{name}.descriptions_us'] = measure(lambda: [engine(html) for html in DESCRIPTIONS], rounds)
+        results[f'html.{name}.long_description_us'] = measure(lambda: engine(SAMPLE_DESC), rounds)
+        tracemalloc.start()
+        engine(SAMPLE_DESC)
+        results[f'html.{name}.peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return results
+
+
+@contextlib.contextmanager
+def temp_repository():
+    """
+    point the course repository of the primary user at an empty database in a temporary directory
+    """
+    user = users.primary
+    repository = user.repository
+    with tempfile.TemporaryDirectory() as directory:
+        # written back in the offload threads, the loop lag of the async engine is measured by `bench_db`
+        engines = create_engines(os.path.join(directory, 'bench.sqlite3'), 'sync')
+        Base.metadata.create_all(engines[0])
+        user.repository = CourseRepository(user.id, engines)
+        try:
+            yield user.repository
+        finally:
+            user.repository = repository
+            engines[0].dispose()
+
+
+def received_courses(first_id: int, count: int, name: str = '课程') -> list:
+    open_at = time.time() + 86400
+    courses = []
+    for i in range(count):
+        course = FakeCourse(first_id + i, open_at, name=f'{name}{i}').to_dict(time.time())
+        courses.append(ReceivedCourseData.from_course(course, users.primary))
+    return courses
+
+
+def bench_sync(courses=200, repeat=5) -> Dict[str, float]:
+    """
+    `ReceivedCourseData.sync_models` on a refreshed catalog of new, changed and unchanged courses,
+    until the changes are written back to sqlite
+    """
+    main.application = None  # no jobs are scheduled for the courses that are not selected
+
+    async def sync(received) -> float:
+        start = time.perf_counter()
+        ReceivedCourseData.sync_models(received)
+        await users.primary.repository.flush()
+        return (time.perf_counter() - start) * 1000
+
+    async def run():
+        timings = {'new': [], 'changed': [], 'unchanged': []}
+        for i in range(repeat):
+            first_id = 100000 + i * courses
+            timings['new'].append(await sync(received_courses(first_id, courses)))
+            timings['unchanged'].append(await sync(received_courses(first_id, courses)))
+            timings['changed'].append(await sync(received_courses(first_id, courses, name='改名课程')))
+        return timings
+
+    with temp_repository():
+        timings = asyncio.run(run())
+    return {f'sync.{kind}_{courses}_ms': min(values) for kind, values in timings.items()}
+
+
+def bench_render(rounds=2000) -> Dict[str, float]:
+    """
+    the messages and keyboards of a course, and a page of the course list
+    """
+    main.application = None
+    with temp_repository():
+        courses = received_courses(200000, 20)
+        ReceivedCourseData.sync_models(courses)
+        course = courses[0]
+        course.teacher, course.description = '模拟教师', html_process.transform(DESCRIPTIONS[0])
+        course_list = {'title': '【可选课程】', 'courses': courses, 'page': 1, 'fetched_at': time.time()}
+        return {
+            'render.get_info_us': measure(lambda: course.get_info(is_detail='no', title='【新的博雅】'), rounds),
+            'render.get_info_detail_us': measure(lambda: course.get_info(is_detail='yes'), rounds),
+            'render.get_reply_markup_us': measure(lambda: course.get_reply_markup('no'), rounds),
+            'render.course_list_page_us': measure(lambda: render_course_list(course_list), rounds // 4),
+        }
+
+
+async def _loop_lag(work, seconds: float) -> list:
+    """
+    run `work` while a ticker sleeps 1ms again and again
+    :return: how late the ticker woke up each time, in milliseconds
+    """
+    lags = []
+    stop = time.perf_counter() + seconds
+
+    async def ticker():
+        while time.perf_counter() < stop:
+            before = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append((time.perf_counter() - before - 0.001) * 1000)
+
+    async def worker():
+        while time.perf_counter() < stop:
+            await asyncio.sleep(0.01)  # the network round trip
+            await work()
+
+    await asyncio.gather(ticker(), *[worker() for _ in range(8)])
+    return lags
+
+
+def lag_results(prefix: str, lags: list) -> Dict[str, float]:
+    return {f'{prefix}.mean_ms': statistics.mean(lags),
+            f'{prefix}.p99_ms': statistics.quantiles(lags, n=100, method='inclusive')[98]}
+
+
+def bench_offload(seconds=2.0) -> Dict[str, float]:
+    """
+    event loop latency under a simulated rush: 8 workers build envelopes, decrypt responses and render descriptions
+    """
+    data_str = json.dumps({'courseId': 12345}).encode()
+    envelope = build_envelope(data_str)
+    response = base64.b64encode(aes_encrypt(json.dumps({'status': '0', 'data': {}}).encode(), envelope.aes_key))
+
+    results = {}
+    for name, threads, processes in [('inline', 0, 0), ('threads', 2, 0), ('threads_html_processes', 2, 2)]:
+        offload = Offload()
+        offload.threads, offload.html_processes = threads, processes
+
+        async def work():
+            await offload.run(build_envelope, data_str)
+            await offload.run(decode_response, response, envelope.aes_key)
+            await offload.run_html(html_process.transform, SAMPLE_DESC)
+
+        lags = asyncio.run(_loop_lag(work, seconds))
+        offload.shutdown()
+        results.update(lag_results(f'offload.{name}', lags))
+    return results
+
+
+def bench_db(seconds=2.0) -> Dict[str, float]:
+    """
+    event loop latency while courses are written back: a transaction of 20 rows every 10ms,
+    through the sync engine on the loop vs through the async engine
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sync_engine, async_engine = create_engines(os.path.join(directory, 'bench.sqlite3'))
+        Base.metadata.create_all(sync_engine)
+        rows = [{'id': i, 'user_id': 0, 'name': f'course {i}', 'start_date': datetime.datetime.now(),
+                 'end_date': datetime.datetime.now(), 'select_start_date': datetime.datetime.now(),
+                 'select_end_date': datetime.datetime.now(), 'cancel_end_date': datetime.datetime.now(),
+                 'status': Course.STATUS_NOT_SELECTED, 'notified': False} for i in range(20)]
+
+        async def sync_write():
+            with sync_engine.begin() as connection:
+                connection.execute(CourseRepository._upsert(), rows)
+
+        async def async_write():
+            async with async_engine.begin() as connection:
+                await connection.execute(CourseRepository._upsert(), rows)
+
+        for name, work in [('sync_engine', sync_write), ('async_engine', async_write)]:
+            if work is async_write and async_engine is None:
+                continue  # aiosqlite is not installed
+            results.update(lag_results(f'db.{name}', asyncio.run(_loop_lag(work, seconds))))
+        if async_engine is not None:
+            asyncio.run(async_engine.dispose())
+        sync_engine.dispose()
+    return results
+
+
+GROUPS = {
+    'crypto': bench_crypto,
+    'envelope': bench_envelope,
+    'html': bench_html,
+    'sync': bench_sync,
+    'render': bench_render,
+    'offload': bench_offload,
+    'db': bench_db,
+}
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'commit': commit,
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], threshold: float) -> bool:
+    """
+    print the change of every result from the baseline
+    :return: False if a result is worse than the baseline by more than `threshold`
+    """
+    ok = True
+    print(f"\n{'benchmark':<45}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<45}{'-':>12}{value:>12.2f}{'new':>10}")
+            continue
+        change = value / old - 1 if old else 0.0
+        mark = ''
+        if change > threshold:
+            ok = False
+            mark = '  REGRESSION'
+        print(f"{name:<45}{old:>12.2f}{value:>12.2f}{change:>+10.1%}{mark}")
+    groups = {name.split('.')[0] for name in results}
+    for name in baseline:
+        if name not in results and name.split('.')[0] in groups:
+            print(f"{name:<45}{baseline[name]:>12.2f}{'-':>12}{'missing':>10}")
+    return ok
+
+
+def run():
+    parser = argparse.ArgumentParser(description='benchmarks of the hot paths')
+    parser.add_argument('groups', nargs='*', help=f"the groups to run, all of them by default: {', '.join(GROUPS)}")
+    parser.add_argument('--save', metavar='PATH', help='save the results as json')
+    parser.add_argument('--compare', metavar='PATH', help='compare with the results saved by an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='the relative slow down reported as a regression, 0.25 by default')
+    args = parser.parse_args()
+    for group in args.groups:
+        if group not in GROUPS:
+            parser.error(f'unknown group {group}')
+
+    if not check_html():
+        sys.exit(1)
+    random.seed(0)  # the same aes keys, and the same inputs, every run
+    results = {}
+    for group in args.groups or GROUPS:
+        group_results = GROUPS[group]()
+        for name, value in group_results.items():
+            print(f"{name:<45}{value:>12.2f}")
+        results.update(group_results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"baseline: {baseline['environment']}")
+        if not compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
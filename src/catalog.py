@@ -0,0 +1,87 @@
+"""
+in-memory snapshot of the semester catalog, kept up to date by the refresh job,
+so that /query_avail answers without waiting for the bykc api
+"""
+import asyncio
+import time
+from typing import Dict, Iterable, List, Optional
+
+from client import Client
+from config import config
+
+
+class CatalogSnapshot:
+    """
+    `courses` are the raw courses returned by `queryStudentSemesterCourseByPage`, as of `fetched_at`
+    """
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.page_size = int(config.get('catalog_page_size') or 20)
+        self.courses: List[dict] = []
+        self.pages: Dict[int, int] = {}  # course id -> the page it is listed on
+        self.fetched_at: Optional[float] = None
+        self._refreshing: Optional[asyncio.Task] = None
+
+    async def refresh(self) -> List[dict]:
+        """
+        fetch the whole catalog, concurrent callers share one fetch
+        """
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.create_task(self._fetch())
+        return await asyncio.shield(self._refreshing)
+
+    async def _fetch(self) -> List[dict]:
+        contents: Dict[int, List[dict]] = {}  # the pages arrive in any order, keep the order of the server
+        async for page, content in self.client.iter_semester_pages(self.page_size):
+            contents[page] = content
+        courses = [course for page in sorted(contents) for course in contents[page]]
+        pages = {course['id']: page for page, content in contents.items() for course in content}
+        self.courses = courses
+        self.pages = pages
+        self.fetched_at = time.time()
+        return courses
+
+    async def poll(self, course_ids: Iterable[int], max_age: float) -> Dict[int, dict]:
+        """
+        the current listing of a few courses, e.g. the waiting ones: read from the snapshot if it is younger than
+        `max_age` seconds, otherwise only the pages they are listed on are fetched again and patched into the snapshot.
+        the whole catalog is fetched only if one of them is not found where it was, e.g. pushed to the next page
+        by new courses
+        :return: the listed courses by id, those not listed are missing
+        """
+        course_ids = set(course_ids)
+        age = self.age()
+        if age is not None and age < max_age:
+            return {course['id']: course for course in self.courses if course['id'] in course_ids}
+        if not course_ids <= self.pages.keys():
+            return {course['id']: course for course in await self.refresh() if course['id'] in course_ids}
+        pages = sorted({self.pages[course_id] for course_id in course_ids})
+        responses = await asyncio.gather(*[self.client.query_student_semester_course_by_page(page, self.page_size)
+                                           for page in pages])
+        listed = {course['id']: course for resp in responses for course in resp['content']
+                  if course['id'] in course_ids}
+        if listed.keys() != course_ids:
+            return {course['id']: course for course in await self.refresh() if course['id'] in course_ids}
+        for course_id, course in listed.items():
+            self.update(course_id, **course)
+        return listed
+
+    async def get(self) -> List[dict]:
+        """
+        the snapshot, fetched first if there is none yet
+        """
+        if self.fetched_at is None:
+            return await self.refresh()
+        return self.courses
+
+    def age(self) -> Optional[float]:
+        return None if self.fetched_at is None else time.time() - self.fetched_at
+
+    def update(self, course_id: int, **fields):
+        """
+        patch a course with what an api call has just told us, e.g. after choosing or cancelling it
+        """
+        for course in self.courses:
+            if course['id'] == course_id:
+                course.update(fields)
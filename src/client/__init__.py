@@ -2,4 +2,5 @@
 This package encapsulates the BYKC web api.
 """
 from .client import Client
+from .token_manager import TokenManager
 from .exceptions import *
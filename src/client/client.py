@@ -1,42 +1,203 @@
 import asyncio
+import functools
 import logging
 import traceback
 
 import binascii
 import datetime
 import json
+import math
 import time
 import warnings
-from typing import overload
+from typing import overload, Optional, Dict, List, Tuple
 
 import httpx
 
 from . import patterns
-from .exceptions import LoginError, AlreadyChosen, FailedToChoose, FailedToDelChosen, TooEarlyToChoose, \
-    LoginExpired, UnknownError, CourseIsFull
+from .exceptions import ApiException, LoginError, AlreadyChosen, FailedToChoose, FailedToDelChosen, \
+    TooEarlyToChoose, LoginExpired, UnknownError, CourseIsFull
 from .sso import SsoApi
+from .clock import ClockEstimator
 from .crypto import *
 
 from config import config
+from metrics import metrics
+from offload import offload
 from storage import storage
 
+API_LATENCY = metrics.histogram('bykc_api_latency_seconds', 'latency of the bykc api calls', ('api',))
+API_ERRORS = metrics.counter('bykc_api_errors_total', 'bykc api calls failed, by exception type', ('api', 'error'))
+LOGINS = metrics.counter('bykc_logins_total', 'logins through sso')
+
+
+def measured(func):
+    """
+    record the latency and the exceptions of an api call, the api name is the first argument
+    """
+
+    @functools.wraps(func)
+    async def wrapper(self, api_name: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(self, api_name, *args, **kwargs)
+        except ApiException as e:
+            API_ERRORS.inc(api=api_name, error=type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - start, api=api_name)
+
+    return wrapper
+
+
+def decode_response(text: bytes, aes_key: bytes) -> dict:
+    """
+    decode and decrypt the body of an api response
+    """
+    try:
+        message_decode_b64 = base64.b64decode(text)
+    except binascii.Error:
+        raise UnknownError(f"unable to parse response: {text}")
+
+    try:
+        return json.loads(aes_decrypt(message_decode_b64, aes_key))
+    except ValueError:
+        raise LoginExpired("failed to decrypt response, it's usually because your login has expired")
+
 
 class Client:
-    def __init__(self, username, password):
+    def __init__(self, username, password, storage_prefix: str = ''):
+        """
+        :param storage_prefix: prefix of the keys the token is kept under in the storage, one per account
+        """
         self.username = username
         self.password = password
+        self.storage_prefix = storage_prefix
         self.token: str = ''
         self.zero_trust_engine: str = ''
+        self.token_validated_at: Optional[float] = None  # last time the token was accepted by the server
+        self._session: Optional[httpx.AsyncClient] = None
+        self.pool_hits = 0  # requests served by an already opened connection
+        self.pool_misses = 0  # requests that had to open a new connection
+        self.clock = ClockEstimator()
+        self._envelopes: Dict[Tuple[str, bytes], List[Envelope]] = {}  # prebuilt request bodies, see `prepare_envelopes`
+        self._login_task: Optional[asyncio.Task] = None  # the login in progress, shared by every caller
+        self.logins = 0  # logins through sso since start
+
+    def _get_session(self) -> httpx.AsyncClient:
+        """
+        get the long-lived connection pool, create it if not yet created or already closed
+        """
+        if self._session is None or self._session.is_closed:
+            max_connections = int(config.get('http_max_connections') or 16)
+            keepalive_expiry = float(config.get('http_keepalive_expiry') or 60)
+            self._session = httpx.AsyncClient(
+                http2=bool(config.get('http2')),
+                limits=httpx.Limits(max_connections=max_connections,
+                                    max_keepalive_connections=max_connections,
+                                    keepalive_expiry=keepalive_expiry),
+            )
+        return self._session
+
+    async def close(self):
+        """
+        close the connection pool
+        """
+        if self._session is not None:
+            await self._session.aclose()
+            self._session = None
+
+    async def _request(self, method: str, url: str, cheap: bool = False, **kwargs) -> httpx.Response:
+        """
+        send a request through the connection pool and count whether a new connection was opened for it,
+        every response is also a sample of the server clock
+        :param cheap: whether the server answers the request instantly, see `ClockEstimator.sample`
+        """
+        connected = False
+
+        async def trace(event_name, info):
+            nonlocal connected
+            if event_name == 'connection.connect_tcp.started':
+                connected = True
+
+        try:
+            sent = time.time()
+            resp = await self._get_session().request(method, url, extensions={'trace': trace}, **kwargs)
+            # connection setup should not be counted in the round trip
+            self.clock.sample(sent, time.time(), resp.headers.get('Date'), cheap and not connected)
+            return resp
+        finally:
+            if connected:
+                self.pool_misses += 1
+            else:
+                self.pool_hits += 1
+
+    async def warm_up(self, connections: int = None):
+        """
+        open connections ahead of time, so that the following api calls do not pay DNS, TCP and TLS setup
+        :param connections: how many connections to open, only one is needed in http2 mode
+        """
+        if connections is None:
+            connections = int(config.get('warm_up_connections') or 4)
+        if config.get('http2'):
+            connections = 1
+        url = config.get('bykc_root') + '/'
+        headers = {'User-Agent': config.get('user_agent')}
+        results = await asyncio.gather(*[self._request('GET', url, cheap=True, headers=headers)
+                                         for _ in range(connections)],
+                                       return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        logging.info(f'warm up: {connections - len(errors)}/{connections} connections ready, '
+                     f'pool hits: {self.pool_hits}, pool misses: {self.pool_misses}')
+
+    async def sync_clock(self, samples: int = 8, interval: float = 0.23):
+        """
+        sample the server clock with cheap requests, the interval is chosen to spread the samples over different
+        sub-second phases
+        """
+        url = config.get('bykc_root') + '/'
+        headers = {'User-Agent': config.get('user_agent')}
+        for i in range(samples):
+            try:
+                await self._request('GET', url, cheap=True, headers=headers)
+            except httpx.HTTPError:
+                pass
+            if i != samples - 1:
+                await asyncio.sleep(interval)
+        logging.info(f'clock synced: {self.clock.summary()}')
+
+    def pool_stats(self) -> dict:
+        return {'hits': self.pool_hits, 'misses': self.pool_misses}
+
+    def prepare_envelopes(self, api_name: str, data: dict, count: int):
+        """
+        build encrypted request bodies ahead of time, so that calling the api later only stamps `ts` and sends
+        :param api_name: the api that will be called
+        :param data: the exact data that will be sent
+        :param count: how many envelopes should be ready, each envelope is used only once
+        """
+        key = (api_name, json.dumps(data).encode())
+        envelopes = self._envelopes.setdefault(key, [])
+        while len(envelopes) < count:
+            envelopes.append(build_envelope(key[1]))
+
+    def discard_envelopes(self, api_name: str, data: dict):
+        self._envelopes.pop((api_name, json.dumps(data).encode()), None)
+
+    def prepare_chose_course(self, course_id: int, count: int):
+        self.prepare_envelopes('choseCourse', {'courseId': course_id}, count)
+
+    def discard_chose_course(self, course_id: int):
+        self.discard_envelopes('choseCourse', {'courseId': course_id})
 
     async def soft_login(self):
         """
         first try to login with token that is stored in config file, if failed, login with username and password
         """
-        if storage.get('token'):
-            self.token = storage.get('token')
+        if storage.get(self.storage_prefix + 'token'):
+            self.token = storage.get(self.storage_prefix + 'token')
             try:
                 result = await self._unsafe_get_user_profile()
-                if result['employeeId'] == config.get('sso_username'):
+                if result['employeeId'] == self.username:
                     print("soft login success")
                     return True
             except Exception:
@@ -58,8 +219,13 @@ class Client:
                     resp = await session.get(url, follow_redirects=False)  # manually redirect
                     searching_token = patterns.token.search(url)
                     if searching_token:
+                        self.logins += 1
+                        LOGINS.inc()
                         self.token = searching_token.group(1)
-                        storage.set('token', self.token)
+                        self.token_validated_at = time.time()
+                        storage.set(self.storage_prefix + 'token', self.token)
+                        storage.set(self.storage_prefix + 'token_obtained_at', self.token_validated_at)
+                        await storage.flush()  # the token must survive a crash
                         print('login success')
                         break
                     elif resp.status_code in [301, 302]:
@@ -70,6 +236,24 @@ class Client:
         except httpx.HTTPError:
             raise LoginError("登录错误:网络错误")
 
+    async def reauthenticate(self, stale_token: Optional[str] = None, soft: bool = True):
+        """
+        single-flight login: however many coroutines find the token expired at the same time, only one login runs,
+        and all of them wait for its result
+        :param stale_token: the token the caller found expired, nothing is done if the token has been replaced since
+        :param soft: reuse the token in storage if it is still valid, see `soft_login`
+        """
+        if stale_token is not None and self.token and self.token != stale_token:
+            return
+        if self._login_task is None or self._login_task.done():
+            stored_token = storage.get(self.storage_prefix + 'token')
+            if soft and stored_token and stored_token != stale_token:
+                self._login_task = asyncio.create_task(self.soft_login())
+            else:
+                self._login_task = asyncio.create_task(self.login())
+        # a cancelled caller, e.g. a rush attempt, must not cancel the login the others are waiting for
+        await asyncio.shield(self._login_task)
+
     def logout(self):
         """
         clear session and logout
@@ -77,17 +261,29 @@ class Client:
         self.token = ''
         self.zero_trust_engine = ''
 
-    async def __call_api(self, api_name: str, data: dict):
-        """call api and try to deal with some exceptions"""
+    async def __call_api(self, api_name: str, data: dict, inline: bool = False, retry: bool = True):
+        """
+        call api and try to deal with some exceptions
+        :param retry: retry up to 3 times on an expired token or an unknown error, pausing 1 second on the latter.
+        if False, the api is called exactly once, and an expired token is replaced before `LoginExpired` is raised
+        """
+        if not retry:
+            token = self.token
+            try:
+                return await self.__call_api_raw(api_name, data, inline)
+            except LoginExpired:
+                await self.reauthenticate(token)
+                raise
         last_exception = None
-        for retry in range(3):
+        for _ in range(3):
+            token = self.token
             try:
-                return await self.__call_api_raw(api_name, data)
+                return await self.__call_api_raw(api_name, data, inline)
             except LoginExpired as e:
                 logging.info('login expired, retrying...' + repr(e))
                 last_exception = e
                 try:
-                    await self.soft_login()
+                    await self.reauthenticate(token)
                 except LoginError as e:
                     last_exception = e
                     await asyncio.sleep(1)
@@ -96,70 +292,72 @@ class Client:
                 await asyncio.sleep(1)
         raise last_exception
 
-    async def __call_api_raw(self, api_name: str, data: dict):
+    @measured
+    async def __call_api_raw(self, api_name: str, data: dict, inline: bool = False):
         """
         an intermediate method to call api which deals with crypto and auth
         :param api_name: could be found in `app.js`
         :param data: could also be found in `app.js`
+        :param inline: do the crypto and json work on the event loop instead of sending it to `offload`,
+        it is faster when the envelope is prebuilt and only a small response needs to be decrypted
         :return: raw data returned by the api
         """
-        if not self.token:
+        token = self.token  # the token may be replaced while the envelope is being built
+        if not token:
             raise LoginExpired("login expired")
         url = config.get('bykc_root') + '/sscv/' + api_name
         data_str = json.dumps(data).encode()
-        aes_key = generate_aes_key()
-        ak = rsa_encrypt(aes_key).decode()
-        data_sign = sign(data_str)
-        sk = rsa_encrypt(data_sign).decode()
+        envelopes = self._envelopes.get((api_name, data_str))
+        if envelopes:
+            envelope = envelopes.pop()
+        elif inline:
+            envelope = build_envelope(data_str)
+        else:
+            envelope = await offload.run(build_envelope, data_str)
+        aes_key = envelope.aes_key
         ts = str(int(time.time() * 1000))
 
-        data_encrypted = base64.b64encode(aes_encrypt(data_str, aes_key))
         headers = {
             'Content-Type': 'application/json;charset=utf-8',
             'User-Agent': config.get('user_agent'),
-            'auth_token': self.token,
-            'authtoken': self.token,
-            'ak': ak,
-            'sk': sk,
+            'auth_token': token,
+            'authtoken': token,
+            'ak': envelope.ak,
+            'sk': envelope.sk,
             'ts': ts,
         }
 
         try:
-            async with httpx.AsyncClient() as session:
-                resp = await session.post(url, content=data_encrypted, headers=headers)
-                text = resp.content
-                if resp.status_code == 302:
-                    raise LoginExpired("login expired")
-                if resp.status_code != 200:
-                    raise UnknownError(f"server panics with http status code: {resp.status_code}")
-                try:
-                    message_decode_b64 = base64.b64decode(text)
-                except binascii.Error:
-                    raise UnknownError(f"unable to parse response: {text}")
-
-                try:
-                    api_resp = json.loads(aes_decrypt(message_decode_b64, aes_key))
-                except ValueError:
-                    raise LoginExpired("failed to decrypt response, it's usually because your login has expired")
-
-                if api_resp['status'] == '98005399':
-                    raise LoginExpired("login expired")
-                elif api_resp['status'] != '0':
-                    if api_resp['errmsg'].find('已报名过该课程，请不要重复报名') >= 0:
-                        raise AlreadyChosen("已报名过该课程，请不要重复报名")
-                    if api_resp['errmsg'].find('该课程还未开始选课，请耐心等待') >= 0:
-                        raise TooEarlyToChoose("该课程还未开始选课，请耐心等待")
-                    if api_resp['errmsg'].find('选课失败，该课程不可选择') >= 0:
-                        raise FailedToChoose('选课失败，该课程不可选择')
-                    if api_resp['errmsg'].find('报名失败，该课程人数已满！') >= 0:
-                        raise CourseIsFull("报名失败，该课程人数已满！")
-                    if api_resp['errmsg'].find('退选失败，未找到退选课程或已超过退选时间') >= 0:
-                        raise FailedToDelChosen("退选失败，未找到退选课程或已超过退选时间")
-                    raise UnknownError(f"server returns a non zero api status code: {api_resp['status']}")
-                return api_resp['data']
+            resp = await self._request('POST', url, content=envelope.body, headers=headers)
         except httpx.HTTPError as e:
             traceback.print_exc()
             raise UnknownError("网络错误" + str(e))
+        text = resp.content
+        if resp.status_code == 302:
+            raise LoginExpired("login expired")
+        if resp.status_code != 200:
+            raise UnknownError(f"server panics with http status code: {resp.status_code}")
+        if inline:
+            api_resp = decode_response(text, aes_key)
+        else:
+            api_resp = await offload.run(decode_response, text, aes_key)
+
+        if api_resp['status'] == '98005399':
+            raise LoginExpired("login expired")
+        elif api_resp['status'] != '0':
+            if api_resp['errmsg'].find('已报名过该课程，请不要重复报名') >= 0:
+                raise AlreadyChosen("已报名过该课程，请不要重复报名")
+            if api_resp['errmsg'].find('该课程还未开始选课，请耐心等待') >= 0:
+                raise TooEarlyToChoose("该课程还未开始选课，请耐心等待")
+            if api_resp['errmsg'].find('选课失败，该课程不可选择') >= 0:
+                raise FailedToChoose('选课失败，该课程不可选择')
+            if api_resp['errmsg'].find('报名失败，该课程人数已满！') >= 0:
+                raise CourseIsFull("报名失败，该课程人数已满！")
+            if api_resp['errmsg'].find('退选失败，未找到退选课程或已超过退选时间') >= 0:
+                raise FailedToDelChosen("退选失败，未找到退选课程或已超过退选时间")
+            raise UnknownError(f"server returns a non zero api status code: {api_resp['status']}")
+        self.token_validated_at = time.time()
+        return api_resp['data']
 
     async def _unsafe_get_user_profile(self):
         """
@@ -188,6 +386,56 @@ class Client:
                                        {'pageNumber': page_number, 'pageSize': page_size})
         return result
 
+    async def iter_semester_courses(self, page_size: int = None, fan_out: int = None):
+        """
+        query the whole catalog and yield courses as pages arrive, see `iter_semester_pages`
+        """
+        async for page, courses in self.iter_semester_pages(page_size, fan_out):
+            for course in courses:
+                yield course
+
+    async def iter_semester_pages(self, page_size: int = None, fan_out: int = None):
+        """
+        query the whole catalog: read the total count from the first page, then fetch the remaining pages concurrently
+        and yield `(page number, courses)` as pages arrive.
+        courses whose selection has ended are skipped, and since the catalog is sorted from new to old,
+        pages after the first one containing such a course are not fetched at all
+        :param page_size: page size
+        :param fan_out: how many pages are fetched at the same time
+        """
+        page_size = page_size or int(config.get('catalog_page_size') or 20)
+        fan_out = fan_out or int(config.get('catalog_fan_out') or 4)
+        now = datetime.datetime.now()
+
+        def expired(course):
+            return now > datetime.datetime.strptime(course['courseSelectEndDate'], '%Y-%m-%d %H:%M:%S')
+
+        first = await self.query_student_semester_course_by_page(1, page_size)
+        yield 1, [course for course in first['content'] if not expired(course)]
+        if any(expired(course) for course in first['content']):
+            return
+        total_pages = first.get('totalPages') or math.ceil(first.get('totalElements', 0) / page_size)
+        last_page = total_pages  # pages after it are not needed
+        semaphore = asyncio.Semaphore(fan_out)
+
+        async def fetch(page):
+            async with semaphore:
+                if page > last_page:
+                    return page, []
+                resp = await self.query_student_semester_course_by_page(page, page_size)
+                return page, resp['content']
+
+        tasks = [asyncio.create_task(fetch(page)) for page in range(2, total_pages + 1)]
+        try:
+            for next_page in asyncio.as_completed(tasks):
+                page, content = await next_page
+                yield page, [course for course in content if not expired(course)]
+                if any(expired(course) for course in content):
+                    last_page = min(last_page, page)
+        finally:
+            for task in tasks:
+                task.cancel()
+
     async def query_course_by_id(self, course_id: int):
         """
         query a course by id
@@ -272,15 +520,17 @@ class Client:
         result = await self.__call_api('queryChosenCourse', data)
         return result
 
-    async def chose_course(self, course_id: int):
+    async def chose_course(self, course_id: int, inline: bool = False, retry: bool = True):
         """
         choose a course
         :param course_id: the course id, could be obtained from `query_student_semester_course_by_page`
+        :param inline: see `__call_api_raw`
+        :param retry: see `__call_api`, a rush sends a single request per attempt and schedules the retries itself
         :return: some useless data if success
         :raise AlreadyChosen: if the course has already been chosen
         :raise FailedToChoose: if failed to choose the course
         """
-        result = await self.__call_api('choseCourse', {'courseId': course_id})
+        result = await self.__call_api('choseCourse', {'courseId': course_id}, inline, retry)
         return result
 
     async def del_chosen_course(self, course_id: int):
@@ -0,0 +1,90 @@
+"""
+estimate the clock offset and the round trip time between us and the bykc server
+"""
+import datetime
+import email.utils
+from typing import Optional
+
+# 博雅系统返回的时间都是北京时间，且不带时区
+BYKC_TZ = datetime.timezone(datetime.timedelta(hours=8))
+
+
+def bykc_timestamp(date: datetime.datetime) -> float:
+    """
+    convert a naive datetime returned by bykc into a unix timestamp
+    """
+    return date.replace(tzinfo=BYKC_TZ).timestamp()
+
+
+class ClockEstimator:
+    """
+    The `Date` header of a response is the server time truncated to whole seconds, taken at some moment between
+    sending the request and receiving the response. So every sample bounds `server time - local time` into an
+    interval, and intersecting the intervals of samples taken at different sub-second phases narrows it down.
+    """
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha  # weight of the newest round trip time sample
+        self.offset_low: Optional[float] = None
+        self.offset_high: Optional[float] = None
+        self.rtt: Optional[float] = None  # smoothed round trip time in seconds
+        self.min_rtt: Optional[float] = None
+        self.samples = 0
+
+    def sample(self, sent: float, received: float, date_header: Optional[str], cheap: bool = False):
+        """
+        :param sent: local timestamp before the request is sent
+        :param received: local timestamp after the response is received
+        :param date_header: the `Date` header of the response
+        :param cheap: whether the server answers the request instantly, only these are used to estimate rtt
+        """
+        if cheap:
+            rtt = received - sent
+            self.rtt = rtt if self.rtt is None else self.rtt * (1 - self.alpha) + rtt * self.alpha
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if not date_header:
+            return
+        try:
+            server = email.utils.parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return
+        low, high = server - received, server + 1 - sent
+        if self.offset_low is None or low > self.offset_high or high < self.offset_low:
+            # the first sample, or one of the clocks has jumped: start over
+            self.offset_low, self.offset_high = low, high
+        else:
+            self.offset_low, self.offset_high = max(self.offset_low, low), min(self.offset_high, high)
+        self.samples += 1
+
+    @property
+    def offset(self) -> float:
+        """
+        server time minus local time in seconds
+        """
+        if self.offset_low is None:
+            return 0.0
+        return (self.offset_low + self.offset_high) / 2
+
+    @property
+    def uncertainty(self) -> float:
+        if self.offset_low is None:
+            return float('inf')
+        return (self.offset_high - self.offset_low) / 2
+
+    def fire_time(self, server_time: float) -> float:
+        """
+        :param server_time: a server side unix timestamp
+        :return: the local unix timestamp to send a request at, so that it reaches the server at `server_time`
+        """
+        return server_time - self.offset - (self.rtt or 0) / 2
+
+    def summary(self) -> str:
+        if self.offset_low is None:
+            offset = 'offset unknown'
+        else:
+            offset = f'offset {self.offset * 1000:+.0f}±{self.uncertainty * 1000:.0f}ms'
+        if self.rtt is None:
+            rtt = 'rtt unknown'
+        else:
+            rtt = f'rtt {self.rtt * 1000:.0f}ms (min {self.min_rtt * 1000:.0f}ms)'
+        return f'{offset}, {rtt}, {self.samples} samples'
@@ -1,4 +1,5 @@
 import base64
+import functools
 import random
 
 from cryptography.hazmat.backends import default_backend
@@ -6,11 +7,24 @@ from cryptography.hazmat.primitives import serialization, padding, hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.asymmetric import padding as asymmetric_padding
 
+from config import config
+
 # 这是一个1024bit的RSA公钥，从'app.js'中可以找到
 RSA_PUBLIC_KEY = b"MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQDlHMQ3B5GsWnCe7Nlo1YiG/YmHdlOiKOST5aRm4iaqYSvhvWmwcigoyWTM+8bv2+sf6nQBRDWTY4KmNV7DBk1eDnTIQo6ENA31k5/tYCLEXgjPbEjCK9spiyB62fCT6cqOhbamJB0lcDJRO6Vo1m3dy+fD0jbxfDVBBNtyltIsDQIDAQAB"
 
-# 需要首先用base64解码，然后再用der格式来load
-public_key = serialization.load_der_public_key(base64.b64decode(RSA_PUBLIC_KEY), backend=default_backend())
+
+@functools.lru_cache(maxsize=4)
+def load_public_key(key: bytes):
+    # 需要首先用base64解码，然后再用der格式来load
+    return serialization.load_der_public_key(base64.b64decode(key), backend=default_backend())
+
+
+def get_public_key():
+    """
+    配置项`bykc_rsa_public_key`可以替换公钥，例如连接本地的模拟服务器时
+    """
+    key = config.get('bykc_rsa_public_key')
+    return load_public_key(key.encode() if key else RSA_PUBLIC_KEY)
 
 
 def generate_aes_key() -> bytes:
@@ -52,5 +66,26 @@ def sign(message: bytes) -> bytes:
 
 
 def rsa_encrypt(message: bytes) -> bytes:
-    encrypted = public_key.encrypt(message, asymmetric_padding.PKCS1v15())
+    encrypted = get_public_key().encrypt(message, asymmetric_padding.PKCS1v15())
     return base64.b64encode(encrypted)
+
+
+class Envelope:
+    """
+    一个已经加密好的请求体，以及解密响应所需的aes密钥
+    发送前只需要填上时间戳`ts`
+    """
+
+    def __init__(self, body: bytes, ak: str, sk: str, aes_key: bytes):
+        self.body = body
+        self.ak = ak
+        self.sk = sk
+        self.aes_key = aes_key
+
+
+def build_envelope(message: bytes) -> Envelope:
+    aes_key = generate_aes_key()
+    ak = rsa_encrypt(aes_key).decode()
+    sk = rsa_encrypt(sign(message)).decode()
+    body = base64.b64encode(aes_encrypt(message, aes_key))
+    return Envelope(body, ak, sk, aes_key)
@@ -47,7 +47,8 @@ class SsoApi:
             async with httpx.AsyncClient() as self._session:
                 self._session.headers['User-Agent'] = config.get('user_agent')
                 login_form = await self.__get_login_form()
-                resp = await self._session.post('https://sso.buaa.edu.cn/login', data=login_form, follow_redirects=False)
+                sso_root = config.get('sso_root') or 'https://sso.buaa.edu.cn'
+                resp = await self._session.post(sso_root + '/login', data=login_form, follow_redirects=False)
                 if resp.status_code != 302:
                     raise LoginError('登录失败:账号密码错误')
                 location = resp.headers['Location']
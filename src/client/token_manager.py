@@ -0,0 +1,95 @@
+import logging
+import time
+from typing import Optional
+
+import httpx
+
+from .client import Client
+from .exceptions import ApiException, LoginExpired
+from config import config
+from storage import storage
+
+
+class TokenManager:
+    """
+    keeps the token fresh in the background, so that time critical calls never find it expired:
+    the token is validated with cheap `getUserProfile` probes, and replaced by a new login before it gets too old
+    """
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.max_age = float(config.get('token_max_age') or 6 * 3600)
+        self.probe_interval = float(config.get('token_probe_interval') or 600)
+        self.probes = 0
+        self.relogins = 0
+
+    def age(self) -> Optional[float]:
+        """
+        seconds since the token was obtained, None if unknown
+        """
+        obtained_at = storage.get(self.client.storage_prefix + 'token_obtained_at')
+        return None if obtained_at is None else time.time() - obtained_at
+
+    def since_validated(self) -> Optional[float]:
+        """
+        seconds since the token was last accepted by the server, None if never
+        """
+        validated_at = self.client.token_validated_at
+        return None if validated_at is None else time.time() - validated_at
+
+    async def probe(self) -> Optional[bool]:
+        """
+        :return: whether the token is accepted by the server, None if the probe itself failed,
+        e.g. on a network error or a 502, the token is then kept as it may well be valid
+        """
+        self.probes += 1
+        try:
+            await self.client._unsafe_get_user_profile()
+            return True
+        except LoginExpired:
+            return False
+        except (ApiException, httpx.HTTPError) as e:
+            logging.warning(f'token probe failed, keep the token: {e!r}')
+            return None
+
+    async def relogin(self):
+        self.relogins += 1
+        await self.client.reauthenticate(soft=False)
+
+    async def maintain(self, max_staleness: float = None, min_remaining: float = 0):
+        """
+        validate the token if it has not been validated within `max_staleness` seconds,
+        and login again if it is invalid or will be older than `max_age` within `min_remaining` seconds
+        """
+        if max_staleness is None:
+            max_staleness = self.probe_interval
+        if not self.client.token:
+            await self.client.reauthenticate()
+            return
+        age = self.age()
+        if age is not None and age + min_remaining > self.max_age:
+            logging.info(f'token is {age:.0f}s old, login again ahead of time')
+            await self.relogin()
+            return
+        since_validated = self.since_validated()
+        if since_validated is not None and since_validated < max_staleness:
+            return
+        if await self.probe() is False:
+            logging.info('token rejected by the probe, login again')
+            await self.relogin()
+
+    async def ensure_fresh(self, max_staleness: float = 30, min_remaining: float = 600):
+        """
+        called before a rush: make sure the token has been validated within `max_staleness` seconds,
+        and will not reach `max_age` during the rush
+        """
+        await self.maintain(max_staleness, min_remaining)
+        logging.info(f'token freshness: {self.freshness()}')
+
+    def freshness(self) -> dict:
+        return {
+            'age': self.age(),
+            'since_validated': self.since_validated(),
+            'probes': self.probes,
+            'relogins': self.relogins,
+        }
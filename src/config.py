@@ -4,14 +4,29 @@ import os
 
 class Config:
     """
-    Config is read-only
+    Config is read-only, `override` only changes it in memory
     """
     path = 'data/config.json'
     keys = [
-        'user_agent', 'bykc_root',
+        'user_agent', 'bykc_root', 'sso_root', 'bykc_rsa_public_key',
         'sso_username', 'sso_password',
         'telegram_token', 'telegram_owner_id',
+        'users', 'chosen_refresh_interval',
         'proxy_url',
+        'http2', 'http_max_connections', 'http_keepalive_expiry', 'warm_up_connections',
+        'envelope_pool_size',
+        'rush_timeout', 'rush_interval', 'rush_burst_interval', 'rush_burst_seconds', 'rush_max_inflight',
+        'rush_attempt_budget',
+        'rush_inline', 'offload_threads', 'offload_html_processes',
+        'catalog_page_size', 'catalog_fan_out',
+        'db_write_delay', 'db_backend', 'db_path',
+        'token_max_age', 'token_probe_interval',
+        'detail_cache_ttl', 'detail_prefetch_concurrency',
+        'html_engine', 'list_page_size',
+        'outbox_global_rate', 'outbox_chat_rate', 'outbox_chat_burst',
+        'waitlist_concurrency', 'waitlist_min_interval', 'waitlist_interval', 'waitlist_max_interval',
+        'refresh_min_interval', 'refresh_max_interval',
+        'metrics_port', 'metrics_host',
     ]
 
     def __init__(self):
@@ -35,5 +50,14 @@ class Config:
             return self.data.get(item)
         raise AttributeError
 
+    def override(self, **items):
+        """
+        replace some items in memory only, e.g. to point the client at a local server in a benchmark
+        """
+        for key in items:
+            if key not in self.keys:
+                raise AttributeError(key)
+        self.data.update(items)
+
 
 config = Config()
@@ -0,0 +1,111 @@
+"""
+process wide cache of course details.
+a detail view is served from the cache if it is younger than the ttl, the html description is rendered once per content
+"""
+import asyncio
+import collections
+import hashlib
+import logging
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import html_process
+from client import Client
+from config import config
+from offload import offload
+
+
+class CourseCache:
+    """
+    usage: `data, description = await course_cache.get(course_id)`,
+    `data` is what `queryCourseById` returns, `description` is the rendered `courseDesc`
+    """
+    max_rendered = 256  # rendered descriptions kept, least recently used ones are dropped
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.ttl = float(config.get('detail_cache_ttl') or 300)
+        self.prefetch_concurrency = int(config.get('detail_prefetch_concurrency') or 2)
+        self.html_engine = config.get('html_engine') or 'stream'
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[int, Tuple[float, dict, str]] = {}  # course id -> (fetched at, data, description)
+        self._rendered: collections.OrderedDict = collections.OrderedDict()  # sha1 of courseDesc -> rendered html
+        self._fetching: Dict[int, asyncio.Task] = {}
+        self._prefetch_semaphore: Optional[asyncio.Semaphore] = None
+
+    async def get(self, course_id: int, max_age: float = None) -> Tuple[dict, str]:
+        """
+        :param max_age: accept a cached entry up to this many seconds old, defaults to the ttl
+        """
+        if max_age is None:
+            max_age = self.ttl
+        entry = self._entries.get(course_id)
+        if entry is not None and time.time() - entry[0] <= max_age:
+            self.hits += 1
+            return entry[1], entry[2]
+        self.misses += 1
+        return await self._fetch(course_id)
+
+    async def _fetch(self, course_id: int) -> Tuple[dict, str]:
+        """
+        concurrent fetches of the same course share one request
+        """
+        task = self._fetching.get(course_id)
+        if task is None:
+            task = asyncio.create_task(self._query(course_id))
+            self._fetching[course_id] = task
+            task.add_done_callback(lambda t: self._fetching.pop(course_id, None))
+        return await asyncio.shield(task)
+
+    async def _query(self, course_id: int) -> Tuple[dict, str]:
+        data = await self.client.query_course_by_id(course_id)
+        description = await self.render(data['courseDesc'])
+        self._entries[course_id] = (time.time(), data, description)
+        return data, description
+
+    async def render(self, course_desc: str) -> str:
+        key = hashlib.sha1((course_desc or '').encode()).hexdigest()
+        description = self._rendered.get(key)
+        if description is not None:
+            self._rendered.move_to_end(key)
+            return description
+        description = await offload.run_html(html_process.transform, course_desc, self.html_engine)
+        self._rendered[key] = description
+        while len(self._rendered) > self.max_rendered:
+            self._rendered.popitem(last=False)
+        return description
+
+    def update(self, course_id: int, **fields):
+        """
+        patch a cached entry with what an api call has just told us, e.g. after choosing or cancelling the course
+        """
+        entry = self._entries.get(course_id)
+        if entry is not None:
+            entry[1].update(fields)
+
+    def invalidate(self, course_id: int):
+        self._entries.pop(course_id, None)
+
+    def prefetch(self, course_ids: Iterable[int]):
+        """
+        fetch the details in the background, a few at a time, so that the first detail view opens instantly
+        """
+        if self._prefetch_semaphore is None:
+            self._prefetch_semaphore = asyncio.Semaphore(self.prefetch_concurrency)
+        for course_id in course_ids:
+            if course_id not in self._entries and course_id not in self._fetching:
+                asyncio.create_task(self._prefetch(course_id))
+
+    async def _prefetch(self, course_id: int):
+        async with self._prefetch_semaphore:
+            if course_id in self._entries:
+                return
+            try:
+                await self._fetch(course_id)
+            except Exception:
+                logging.exception(f'failed to prefetch course {course_id}')
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                'rendered': len(self._rendered)}
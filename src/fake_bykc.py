@@ -0,0 +1,363 @@
+"""
+a local stand-in of the bykc system and of the sso login in front of it, speaking the real protocol:
+the aes key wrapped by rsa in `ak`, the body encrypted by aes-ecb, the sha1 signature in `sk`.
+it serves the apis the rush needs, with configurable capacity, opening time, latency, jitter and injected errors.
+run `python src/fake_bykc.py` to try the bot against it, or see `rush_bench.py` and `login_check.py`
+"""
+import argparse
+import asyncio
+import base64
+import bisect
+import datetime
+import email.utils
+import json
+import logging
+import math
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding as asymmetric_padding
+
+from client.clock import BYKC_TZ
+from client.crypto import aes_encrypt, aes_decrypt, sign
+
+STATUS_LOGIN_EXPIRED = '98005399'
+
+HTTP_REASONS = {200: 'OK', 302: 'Found', 401: 'Unauthorized', 404: 'Not Found', 502: 'Bad Gateway'}
+
+
+def bykc_date(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, BYKC_TZ).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ApiError(Exception):
+    """
+    answered with a non zero status and the message as `errmsg`
+    """
+
+
+class FakeCourse:
+    """
+    a course opening at `open_at`, server time. `rivals` other students ask for a seat in the first `rival_spread`
+    seconds after the opening, and the seats go to whoever arrives first
+    """
+
+    def __init__(self, course_id: int, open_at: float, capacity: int = 30, rivals: int = 0,
+                 rival_spread: float = 1.0, name: str = None):
+        self.id = course_id
+        self.name = name or f'模拟课程{course_id}'
+        self.open_at = open_at
+        self.capacity = capacity
+        self.chosen: Dict[str, float] = {}  # token -> server time the seat was taken
+        self.rival_arrivals = sorted(open_at + random.uniform(0, rival_spread) for _ in range(rivals))
+
+    def current_count(self, now: float) -> int:
+        return min(self.capacity, len(self.chosen) + bisect.bisect_right(self.rival_arrivals, now))
+
+    def to_dict(self, now: float, token: str = None) -> dict:
+        return {
+            'id': self.id,
+            'courseName': self.name,
+            'courseTeacher': '模拟教师',
+            'coursePosition': '模拟地点',
+            'courseDesc': f'<p>{self.name}的简介</p>',
+            'courseStartDate': bykc_date(self.open_at + 7 * 86400),
+            'courseEndDate': bykc_date(self.open_at + 7 * 86400 + 7200),
+            'courseSelectStartDate': bykc_date(self.open_at),
+            'courseSelectEndDate': bykc_date(self.open_at + 3 * 86400),
+            'courseCancelEndDate': bykc_date(self.open_at + 6 * 86400),
+            'courseCurrentCount': self.current_count(now),
+            'courseMaxCount': self.capacity,
+            'selected': token in self.chosen,
+        }
+
+
+class FakeBykc:
+    """
+    usage: `base_url = server.start()` serves in a background thread, then point the client at it with
+    `config.override(bykc_root=base_url, sso_root=base_url + '/sso', bykc_rsa_public_key=server.public_key)`
+    """
+
+    def __init__(self, username: str = 'bench', password: str = 'bench', courses: List[FakeCourse] = None,
+                 latency: float = 0.02, jitter: float = 0.01, error_rate: float = 0.0, skew: float = 0.0,
+                 token_ttl: float = None):
+        """
+        :param latency: round trip time of every request in seconds, half of it before the request is handled
+        :param jitter: up to this many seconds are added to the latency at random
+        :param error_rate: the share of api calls answered by a 502 or a non zero status
+        :param skew: server time minus local time in seconds
+        :param token_ttl: tokens expire after this many seconds, never by default
+        """
+        self.username = username
+        self.password = password
+        self.courses: Dict[int, FakeCourse] = {course.id: course for course in courses or []}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.skew = skew
+        self.token_ttl = token_ttl
+        self._private_key = rsa.generate_private_key(65537, 1024, default_backend())
+        self.public_key = base64.b64encode(self._private_key.public_key().public_bytes(
+            serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)).decode()
+        self.base_url = ''
+        self._sessions: Dict[str, Tuple[str, str]] = {}  # sso session cookie -> (execution, service)
+        self._tickets: Dict[str, str] = {}  # service ticket -> username
+        self._tokens: Dict[str, float] = {}  # token -> issued at
+        self.requests: Dict[str, int] = {}  # by api name or path
+        self.outcomes: Dict[str, int] = {}  # of choseCourse
+        self.logins = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def now(self) -> float:
+        return time.time() + self.skew
+
+    def expire_tokens(self):
+        """
+        invalidate every token issued so far, as if they all expired at once
+        """
+        self._tokens.clear()
+
+    ### http ###
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.base_url = f'http://{host}:{port}'
+        return self.base_url
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """
+        serve in a thread with its own event loop, so that the server does not share the loop of the client
+        """
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.serve(host, port))
+            ready.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='fake-bykc', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self.base_url
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            # requests still being answered, e.g. of the rush attempts cancelled by the client
+            handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in handlers:
+                task.cancel()
+            await asyncio.gather(*handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+
+                one_way = (self.latency + random.uniform(0, self.jitter)) / 2
+                await asyncio.sleep(one_way)
+                status, extra_headers, content = self._dispatch(method, target, headers, body)
+                date = email.utils.formatdate(self.now(), usegmt=True)  # taken when the request is handled
+                await asyncio.sleep(one_way)
+
+                lines = [f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}',
+                         f'Date: {date}',
+                         f'Content-Length: {len(content)}']
+                lines += [f'{name}: {value}' for name, value in extra_headers.items()]
+                writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ValueError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            pass  # by `stop`, the connection is dropped
+        finally:
+            writer.close()
+
+    def _dispatch(self, method: str, target: str, headers: dict, body: bytes) -> Tuple[int, dict, bytes]:
+        url = urllib.parse.urlsplit(target)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path.startswith('/sscv/') and method == 'POST':
+            return self._api(url.path[len('/sscv/'):], headers, body)
+        self.requests[url.path] = self.requests.get(url.path, 0) + 1
+        if url.path == '/sscv/cas/login':
+            service = urllib.parse.quote(self.base_url + '/sscv/casLogin', safe='')
+            return 302, {'Location': f'{self.base_url}/sso/login?service={service}'}, b''
+        if url.path == '/sso/login' and method == 'GET':
+            return self._sso_form(query.get('service', ''))
+        if url.path == '/sso/login' and method == 'POST':
+            return self._sso_submit(headers, body)
+        if url.path == '/sscv/casLogin':
+            username = self._tickets.pop(query.get('ticket', ''), None)
+            if username is None:
+                return 401, {}, b'invalid ticket'
+            token = secrets.token_hex(16)
+            self._tokens[token] = self.now()
+            self.logins += 1
+            return 302, {'Location': f'{self.base_url}/system/home?token={token}'}, b''
+        if method == 'GET':
+            return 200, {'Content-Type': 'text/html'}, b'<html></html>'  # the home page, also used for warm up
+        return 404, {}, b''
+
+    ### sso ###
+
+    def _sso_form(self, service: str) -> Tuple[int, dict, bytes]:
+        session = secrets.token_hex(8)
+        execution = secrets.token_hex(8)
+        self._sessions[session] = (execution, service)
+        page = f'<form method="post"><input name="execution" value="{execution}"/></form>'
+        return 200, {'Content-Type': 'text/html; charset=utf-8', 'Set-Cookie': f'SESSION={session}; Path=/'}, \
+            page.encode()
+
+    def _sso_submit(self, headers: dict, body: bytes) -> Tuple[int, dict, bytes]:
+        cookies = dict(part.strip().split('=', 1) for part in headers.get('cookie', '').split(';') if '=' in part)
+        session = self._sessions.pop(cookies.get('SESSION', ''), None)
+        form = dict(urllib.parse.parse_qsl(body.decode()))
+        if session is None or form.get('execution') != session[0] \
+                or form.get('username') != self.username or form.get('password') != self.password:
+            return 401, {'Content-Type': 'text/html; charset=utf-8'}, '用户名或密码错误'.encode()
+        ticket = 'ST-' + secrets.token_hex(8)
+        self._tickets[ticket] = form['username']
+        separator = '&' if '?' in session[1] else '?'
+        return 302, {'Location': f'{session[1]}{separator}ticket={ticket}'}, b''
+
+    ### api ###
+
+    def _decrypt(self, value: str) -> bytes:
+        return self._private_key.decrypt(base64.b64decode(value), asymmetric_padding.PKCS1v15())
+
+    def _api(self, api_name: str, headers: dict, body: bytes) -> Tuple[int, dict, bytes]:
+        self.requests[api_name] = self.requests.get(api_name, 0) + 1
+        try:
+            aes_key = self._decrypt(headers['ak'])
+            message = aes_decrypt(base64.b64decode(body), aes_key)
+            if self._decrypt(headers['sk']) != sign(message):
+                return 401, {}, b'bad signature'
+            data = json.loads(message)
+        except (KeyError, ValueError):
+            return 401, {}, b'bad request'
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return 502, {}, b'bad gateway'
+            result = {'status': '1', 'errmsg': '系统繁忙，请稍后再试', 'data': None}
+        else:
+            result = self._call(api_name, headers.get('authtoken', ''), data)
+        return 200, {'Content-Type': 'text/plain'}, base64.b64encode(aes_encrypt(json.dumps(result).encode(), aes_key))
+
+    def _call(self, api_name: str, token: str, data: dict) -> dict:
+        issued_at = self._tokens.get(token)
+        if issued_at is None or (self.token_ttl is not None and self.now() - issued_at > self.token_ttl):
+            return {'status': STATUS_LOGIN_EXPIRED, 'errmsg': '登录已过期', 'data': None}
+        handler = getattr(self, '_api_' + api_name, None)
+        if handler is None:
+            return {'status': '1', 'errmsg': f'未实现的接口{api_name}', 'data': None}
+        try:
+            return {'status': '0', 'errmsg': '', 'data': handler(token, data)}
+        except ApiError as e:
+            return {'status': '1', 'errmsg': str(e), 'data': None}
+
+    def _course(self, course_id) -> FakeCourse:
+        course = self.courses.get(course_id)
+        if course is None:
+            raise ApiError('课程不存在')
+        return course
+
+    def _api_getUserProfile(self, token: str, data: dict) -> dict:
+        return {'employeeId': self.username, 'realName': '模拟用户'}
+
+    def _api_queryStudentSemesterCourseByPage(self, token: str, data: dict) -> dict:
+        page_number, page_size = int(data['pageNumber']), int(data['pageSize'])
+        now = self.now()
+        courses = sorted(self.courses.values(), key=lambda c: c.open_at, reverse=True)  # from new to old
+        content = courses[(page_number - 1) * page_size:page_number * page_size]
+        return {'content': [course.to_dict(now, token) for course in content], 'totalElements': len(courses),
+                'totalPages': math.ceil(len(courses) / page_size)}
+
+    def _api_queryCourseById(self, token: str, data: dict) -> dict:
+        return self._course(data['id']).to_dict(self.now(), token)
+
+    def _api_getAllConfig(self, token: str, data: dict) -> dict:
+        year = datetime.date.today().year
+        return {'semester': [{'id': 1, 'semesterStartDate': f'{year}-01-01 00:00:00',
+                              'semesterEndDate': f'{year}-12-31 23:59:59'}]}
+
+    def _api_queryChosenCourse(self, token: str, data: dict) -> dict:
+        now = self.now()
+        return {'courseList': [{'courseInfo': course.to_dict(now, token)}
+                               for course in self.courses.values() if token in course.chosen]}
+
+    def _api_choseCourse(self, token: str, data: dict) -> dict:
+        course = self._course(data['courseId'])
+        now = self.now()
+        if token in course.chosen:
+            outcome, error = 'already_chosen', '已报名过该课程，请不要重复报名'
+        elif now < course.open_at:
+            outcome, error = 'too_early', '该课程还未开始选课，请耐心等待'
+        elif course.current_count(now) >= course.capacity:
+            outcome, error = 'full', '报名失败，该课程人数已满！'
+        else:
+            outcome, error = 'selected', None
+            course.chosen[token] = now
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if error is not None:
+            raise ApiError(error)
+        return {'courseCurrentCount': course.current_count(now)}
+
+    def _api_delChosenCourse(self, token: str, data: dict) -> dict:
+        course = self._course(data['id'])
+        if course.chosen.pop(token, None) is None:
+            raise ApiError('退选失败，未找到退选课程或已超过退选时间')
+        return {}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='serve a local stand-in of bykc and sso')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--courses', type=int, default=3)
+    parser.add_argument('--open-in', type=float, default=120, help='seconds until the courses open')
+    parser.add_argument('--capacity', type=int, default=30)
+    parser.add_argument('--rivals', type=int, default=60)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    open_at = math.ceil(time.time() + args.open_in)
+    courses = [FakeCourse(100 + i, open_at, args.capacity, args.rivals) for i in range(args.courses)]
+    server = FakeBykc(courses=courses, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    base_url = await server.serve('127.0.0.1', args.port)
+    print(f'"bykc_root": "{base_url}",\n"sso_root": "{base_url}/sso",\n'
+          f'"bykc_rsa_public_key": "{server.public_key}",\n'
+          f'"sso_username": "{server.username}",\n"sso_password": "{server.password}"')
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
@@ -0,0 +1,109 @@
+"""
+golden outputs of `html_process.transform`, every engine must reproduce them exactly,
+and real course descriptions, on which the engines must agree.
+checked by `python src/benchmark.py`
+"""
+
+CORPUS = [
+    ('paragraphs',
+     '<p>第一段</p><p>第二段</p>',
+     '第一段\n\n第二段'),
+    ('nested spans',
+     '<p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">腾讯会议：</span></span><strong><span style="font-family: 黑体;">324-195-464</span></strong></p>',
+     '腾讯会议：<strong>324-195-464</strong>'),
+    ('line breaks',
+     '<p><span style="font-family:宋体"></span><br/></p><p>1、主讲人介绍： &nbsp;&nbsp;</p><p><br/></p>',
+     '1、主讲人介绍：'),
+    ('formatting tags',
+     '<b>b</b><strong>strong</strong><i>i</i><em>em</em><u>u</u><ins>ins</ins><s>s</s><strike>strike</strike><del>del</del>',
+     '<b>b</b><strong>strong</strong><i>i</i><em>em</em><u>u</u><ins>ins</ins><s>s</s><strike>strike</strike><del>del</del>'),
+    ('upper case tags',
+     '<P>A</P><BR>c<B>d</B>',
+     'A\n\nc<b>d</b>'),
+    ('misnested tags',
+     '<b><i>x</b>y</i>',
+     '<b><i>x</i></b>y'),
+    ('unclosed tags',
+     '<p>unclosed <b>bold',
+     'unclosed <b>bold</b>'),
+    ('stray end tag',
+     '</b>x</p>',
+     'x'),
+    ('self closing tags',
+     '<b/>x<p/>',
+     '<b></b>x'),
+    ('void tags',
+     '<img src="a.png">after<hr>line',
+     'afterline'),
+    ('entities',
+     '&lt;b&gt; &amp; &nbsp;x &quot;q&quot;',
+     '<b> & \xa0x "q"'),
+    ('char refs',
+     'a &notanentity; &#x41; &#65; &#150; &#65',
+     'a &notanentity A A – &#65'),
+    ('comments',
+     '<p>a<!-- c -->b</p><b>x</b>  <!--c-->  <i>y</i>',
+     'ab\n\n<b>x</b>  <i>y</i>'),
+    ('script and style',
+     '<script>var x = "<b>";</script>z<style>p {color: red}</style>w',
+     'zw'),
+    ('doctype and pi',
+     '<!DOCTYPE html><?php x ?><b>x</b>',
+     '<b>x</b>'),
+    ('cdata',
+     '<![CDATA[foo]]>q<b>x</b><![CDATA[]]><i>y</i>',
+     'fooq<b>x</b> <i>y</i>'),
+    ('whitespace between tags',
+     '<b>x</b>   <i>y</i>\n\n\n<u>z</u>',
+     '<b>x</b> <i>y</i>\n\n<u>z</u>'),
+    ('pre',
+     '<pre> <b>x</b>   <i>y</i></pre>',
+     '<b>x</b>   <i>y</i>'),
+    ('ruby and template',
+     '<ruby>漢<rp>(</rp><rt>kan</rt><rp>)</rp></ruby><template>hidden<b>t</b></template>',
+     '漢<b></b>'),
+    # bs4 leaves the `<br/>` open after a `<br>`, so everything after it is lost
+    ('text after br',
+     'x<br>a<br/>b<b>c</b>',
+     'x\n\na'),
+    ('end br',
+     '<span>a<br></br>  b</span>',
+     'a\n\nb'),
+    ('lists and tables',
+     '<ul><li>a<li>b</ul><table><tr><td>x</td><td>y</td></tr></table>',
+     'abxy'),
+]
+
+# course descriptions as the bykc editor produces them, the input of the html benchmark
+DESCRIPTIONS = [
+    '<p style="text-indent:2em"><span style="font-family:宋体;font-size:16px">一、课程简介</span></p>'
+    '<p style="text-indent:2em"><span style="font-family:宋体;font-size:16px">本讲座围绕大学生心理健康展开，'
+    '介绍常见的情绪困扰及其应对方法，帮助同学们建立积极的自我认知。</span></p>'
+    '<p style="text-indent:2em"><span style="font-family:宋体;font-size:16px">二、主讲人介绍</span></p>'
+    '<p style="text-indent:2em"><span style="font-family:宋体;font-size:16px">张老师，心理学博士，'
+    '国家二级心理咨询师，长期从事高校心理健康教育工作。</span></p>'
+    '<p><span style="font-family:宋体;font-size:16px">三、注意事项</span></p>'
+    '<p><span style="font-family:宋体;font-size:16px">1、请提前10分钟到场签到；<br/>2、讲座期间请将手机调至静音；'
+    '<br/>3、迟到超过15分钟不予签到。</span></p>',
+
+    '<p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">'
+    '<span style="font-family:宋体">腾讯会议：</span></span><strong><span style="font-family: 黑体;">'
+    '324-195-464</span></strong></p><p><span style="font-family:宋体">会议密码：</span>'
+    '<strong>0412</strong></p><p><br/></p><p><span style="font-family:宋体">请使用实名入会，'
+    '格式为&nbsp;学号+姓名，否则不计入考勤。</span></p>',
+
+    '<div class="WordSection1"><p class="MsoNormal" style="line-height:150%">'
+    '<b><span style="font-size:14.0pt;line-height:150%;font-family:黑体">【博雅讲坛】航天精神与时代担当</span></b></p>'
+    '<p class="MsoNormal" style="text-indent:24.0pt;line-height:150%"><span style="font-family:宋体">'
+    '本次讲座邀请航天领域专家，结合我国载人航天工程的发展历程，讲述航天人“特别能吃苦、特别能战斗、'
+    '特别能攻关、特别能奉献”的精神内涵。</span></p>'
+    '<p class="MsoNormal" style="text-indent:24.0pt;line-height:150%"><span style="font-family:宋体">'
+    '讲座时长约90分钟，其中互动答疑环节约20分钟。</span><span lang="EN-US"><o:p></o:p></span></p>'
+    '<table class="MsoTableGrid" border="1"><tr><td><p>时间</p></td><td><p>内容</p></td></tr>'
+    '<tr><td><p>19:00-20:10</p></td><td><p>主题报告</p></td></tr>'
+    '<tr><td><p>20:10-20:30</p></td><td><p>互动答疑</p></td></tr></table></div>',
+
+    '<p>课程为线下体育类活动，请穿着运动服装及运动鞋参加。</p><ul><li>集合地点：体育馆东门</li>'
+    '<li>器材由学校提供</li><li>如遇雨天改至室内进行，另行通知</li></ul>'
+    '<p><i>本活动计入美育与体育类博雅学分。</i></p>',
+]
@@ -1,10 +1,15 @@
 """
-this function process html into telegram defined markup language
+this function process html into telegram defined markup language.
+there are two engines with identical output: `stream` (the default) transforms the html in one pass over the tokens
+of the stdlib `HTMLParser`, `bs4` builds a BeautifulSoup tree first and walks it
 """
+import html.parser
 import re
-from typing import List
+from typing import List, Optional, Tuple
 import bs4
 
+FORMATTING_TAGS = {'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del'}
+
 
 def walk(node: bs4.PageElement, result: List[str]):
     if isinstance(node, bs4.Tag):
@@ -12,7 +17,7 @@ def walk(node: bs4.PageElement, result: List[str]):
             result.append('\n')
             walkChildren(node, result)
             result.append('\n')
-        elif node.name in ['b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del']:
+        elif node.name in FORMATTING_TAGS:
             # https://core.telegram.org/bots/update56kabdkb12ibuisabdubodbasbdaosd
             result.append(f'<{node.name}>')
             walkChildren(node, result)
@@ -30,11 +35,14 @@ def walkChildren(node: bs4.Tag, result: List[str]):
         walk(child, result)
 
 
+CONTINUOUS_NEWLINE = re.compile(r'\s*\n\s*')
+
+
 def remove_continuous_newline(text: str) -> str:
-    return re.compile(r'\s*\n\s*').sub('\n\n', text)
+    return CONTINUOUS_NEWLINE.sub('\n\n', text)
 
 
-def transform(s: str) -> str:
+def transform_bs4(s: str) -> str:
     node = bs4.BeautifulSoup(s, 'html.parser')
     result = []
     walk(node, result)
@@ -43,6 +51,162 @@ def transform(s: str) -> str:
     return result
 
 
+class StreamTransformer(html.parser.HTMLParser):
+    """
+    emits the output of `walk` while tokenizing, keeping only a stack of the open tags.
+    it follows how bs4 builds the tree with html.parser, so that the output is exactly the same:
+    an end tag closes the most recent open tag of that name and every tag opened after it, void tags are closed at once,
+    whitespace-only strings shrink to one space or newline, and the text of comments, declarations, `script`,
+    `style`, `template`, `rt` and `rp` is dropped. everything inside a `br` is dropped, as `walk` skips its children
+    """
+    VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link', 'menuitem', 'meta',
+                 'param', 'source', 'track', 'wbr',
+                 'basefont', 'bgsound', 'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'}
+    HIDDEN_TEXT_TAGS = {'rt', 'rp', 'style', 'script', 'template'}
+    PRESERVE_WHITESPACE_TAGS = {'pre', 'textarea'}
+    ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.result: List[str] = []
+        self._stack: List[Tuple[str, Optional[str]]] = []  # open tags and what to emit when they are closed
+        self._data: List[str] = []
+        self._already_closed_void: List[str] = []
+        self._inside_br = 0
+        self._hidden_text = 0
+        self._preserve_whitespace = 0
+
+    def _end_data(self, visible: bool = True):
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        if not self._preserve_whitespace and not data.strip(self.ASCII_SPACES):
+            data = '\n' if '\n' in data else ' '
+        if visible and not self._inside_br:
+            self.result.append(data)
+
+    def _push(self, name: str):
+        closing = None
+        if not self._inside_br:
+            if name == 'p':
+                self.result.append('\n')
+                closing = '\n'
+            elif name in FORMATTING_TAGS:
+                self.result.append(f'<{name}>')
+                closing = f'</{name}>'
+            elif name == 'br':
+                self.result.append('\n')
+        self._stack.append((name, closing))
+        self._count(name, 1)
+
+    def _count(self, name: str, delta: int):
+        if name == 'br':
+            self._inside_br += delta
+        if name in self.HIDDEN_TEXT_TAGS:
+            self._hidden_text += delta
+        if name in self.PRESERVE_WHITESPACE_TAGS:
+            self._preserve_whitespace += delta
+
+    def _pop_to(self, name: str):
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == name:
+                break
+        else:
+            return
+        while len(self._stack) > i:
+            self._pop()
+
+    def _pop(self):
+        name, closing = self._stack.pop()
+        self._count(name, -1)
+        if closing is not None:
+            self.result.append(closing)
+
+    def handle_starttag(self, tag, attrs, void_closes=True):
+        self._end_data(not self._hidden_text)
+        self._push(tag)
+        if void_closes and tag in self.VOID_TAGS:
+            self._pop()
+            self._already_closed_void.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs, void_closes=False)
+        self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self._already_closed_void:
+            self._already_closed_void.remove(tag)  # bs4 ignores it, without even ending the current string
+        else:
+            self._end_data(not self._hidden_text)
+            self._pop_to(tag)
+
+    def handle_data(self, data):
+        self._data.append(data)
+
+    def handle_charref(self, name):
+        if name.startswith('x') or name.startswith('X'):
+            code = int(name.lstrip('xX'), 16)
+        else:
+            code = int(name)
+        data = None
+        if code < 256:
+            try:
+                data = bytearray([code]).decode('windows-1252')
+            except UnicodeDecodeError:
+                pass
+        if not data:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or '\N{REPLACEMENT CHARACTER}')
+
+    def handle_entityref(self, name):
+        character = bs4.dammit.EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else f'&{name}')
+
+    def _hidden(self, data: str):
+        """
+        comments, declarations and processing instructions end the current string and are not shown
+        """
+        self._end_data(not self._hidden_text)
+        self._data.append(data)
+        self._end_data(False)
+
+    handle_comment = handle_decl = handle_pi = _hidden
+
+    def unknown_decl(self, data):
+        if data.upper().startswith('CDATA['):
+            self._end_data(not self._hidden_text)
+            self._data.append(data[len('CDATA['):])
+            self._end_data()
+        else:
+            self._hidden(data)
+
+    def close(self):
+        super().close()
+        self._end_data(not self._hidden_text)
+        while self._stack:
+            self._pop()
+
+
+def transform_stream(s: str) -> str:
+    parser = StreamTransformer()
+    parser.feed(s)
+    parser.close()
+    result = ''.join(parser.result).strip()
+    result = remove_continuous_newline(result)
+    return result
+
+
+ENGINES = {'stream': transform_stream, 'bs4': transform_bs4}
+
+
+def transform(s: str, engine: str = 'stream') -> str:
+    return ENGINES[engine](s)
+
+
 if __name__ == '__main__':
     x = transform(
         """<p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">腾讯会议：</span></span><strong><span style="font-family: 黑体;">324-195-464</span></strong></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体"></span></span><br/></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">1、主讲人介绍： &nbsp;&nbsp;</span></span></p><p><strong><span style="font-family: 宋体;font-size: 16px;background: rgb(255, 255, 255)"><span style="font-family:宋体">吴斌荣：</span></span></strong><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">作家，编辑，策展人，出版副编审。儿童问题研究者，上海市宝山区作家协会副主席，魔仙堡女主，</span><span style="font-family:宋体">Ashtanga练习者。教育学学士，教师中高级职称。</span></span></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">&nbsp;</span></p><p><strong><span style="font-family: 宋体;font-size: 16px;background: rgb(255, 255, 255)"><span style="font-family:宋体">咕咚</span></span></strong><strong><span style="font-family: 宋体;font-size: 16px;background: rgb(255, 255, 255)"><span style="font-family:宋体">：</span></span></strong><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">独立插画师，从事插画和绘本创作</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">，以及儿童绘画教育</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">。</span>2017年入围金风车国际青年插画家大赛。2019年</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">作品《小红帽》</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">入围韩国</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">南怡岛</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">插画绘本短名单，作品在韩国首尔展出。</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">图画书</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">作品《臭袜子不见了》荣获第二届</span><span style="font-family:宋体">“青铜葵花图画书奖” </span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">的</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">“妙趣横生奖”。</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">出版后入选</span><span style="font-family:宋体">2</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">021</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">年度</span><span style="font-family:宋体">“童阅中国”原创好童书，入选2</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">021</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">三叶草年度好童书评选</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">TOP100</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">榜单。图画书作品《金绣娘》入选</span><span style="font-family:宋体">2</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">022</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">年度</span><span style="font-family:宋体">“妈妈的选择｜中国原创好绘本”，入围第八届爱丽丝绘本奖书单和原创组短名单。</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">目前已出版</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">绘本《金绣娘》、</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">《臭袜子不见了》、</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">《食物的旅程》、</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">《小心！病毒入侵》</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">，在《看图说话》杂志发表《出发！去海岛寻宝》《了不起的岩石》《读懂一粒沙》《化石》等。即将出版绘本《恐龙之夜》、《担心养不活却养活了自己的小猪》。</span></span></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)">&nbsp;</span></p><p><strong><span style="font-family: 宋体;font-size: 16px;background: rgb(255, 255, 255)"><span style="font-family:宋体">2、讲座内容：</span></span></strong></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">绘本中的民俗记忆与叙事重构</span></span></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">非遗</span><span style="font-family:宋体">·绘本·儿童·市场 童书编辑的工作</span></span></p><p><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">当下绘本领域的创作者、从业者和研究者正从</span><span style="font-family:宋体">“引进绘本”的热潮，开始朝向“本土绘本”聚焦，大家共同关注的焦点是：中国传统文化如何恰当地融入当下“本土绘本”创作</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">。</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">本讲座以</span>2022年出版的非遗传承绘本《金绣娘》为例，从田野调查（采风）、文本故事创作、图像故事创作三个方面，来探讨作为传统文化的民俗记忆如何通过文本和图像的双重叙事重构，转化为适合儿童阅读的绘本。此外，绘本不是创作者个人</span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">的</span></span><span style=";font-family:宋体;font-size:16px;background:rgb(255,255,255)"><span style="font-family:宋体">产物，而是团队合作的产物。一本面世的绘本，不只是创作者个人努力的结果，后期的装帧设计、排版印刷、宣传发行等等环节，都凝聚着一个团队的力量。</span></span></p><p><br/></p>""")
@@ -0,0 +1,64 @@
+"""
+check against `fake_bykc` that login is single-flight, run with `python src/login_check.py`.
+the server invalidates every token at once, then many api calls find their token expired together:
+exactly one sso login must run, and every call must succeed with the new token
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+from client import Client
+from config import config
+from fake_bykc import FakeBykc, FakeCourse
+from storage import storage
+
+
+async def check(args) -> bool:
+    server = FakeBykc(courses=[FakeCourse(100, 0)], latency=args.latency, jitter=args.jitter)
+    base_url = server.start()
+    config.override(bykc_root=base_url, sso_root=base_url + '/sso', bykc_rsa_public_key=server.public_key)
+    client = Client(server.username, server.password)
+    ok = True
+    try:
+        await client.reauthenticate(soft=False)
+        for round_ in range(1, args.rounds + 1):
+            server.expire_tokens()
+            logins = server.logins
+            # the same mix of calls as the bot makes: profile probes, catalog pages and course details
+            calls = [client.get_user_profile() if i % 3 == 0 else
+                     client.query_student_semester_course_by_page(1, 20) if i % 3 == 1 else
+                     client.query_course_by_id(100) for i in range(args.calls)]
+            results = await asyncio.gather(*calls, return_exceptions=True)
+            errors = [r for r in results if isinstance(r, Exception)]
+            print(f'round {round_}: {args.calls} concurrent calls, {server.logins - logins} login(s), '
+                  f'{len(errors)} failed call(s)')
+            if server.logins - logins != 1 or errors:
+                ok = False
+    finally:
+        await client.close()
+        server.stop()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='check that concurrent token expiries cause a single login')
+    parser.add_argument('--calls', type=int, default=20, help='api calls finding the token expired together')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.03, help='round trip time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        storage.path = os.path.join(directory, 'storage.json')  # keep the tokens of the bot untouched
+        storage.data = {}
+        ok = asyncio.run(check(args))
+    print('ok: one login per expiry' if ok else 'FAILED: expected exactly one login per expiry and no failed call')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 import datetime
-import json
+import functools
 import logging
 import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, \
@@ -9,24 +11,42 @@ from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, Callb
 from telegram.ext import filters
 from telegram.error import TelegramError
 
-import html_process
-from client import Client, FailedToChoose, AlreadyChosen, CourseIsFull, ApiException, TooEarlyToChoose, \
+from client import FailedToChoose, AlreadyChosen, CourseIsFull, ApiException, TooEarlyToChoose, \
     FailedToDelChosen
+from client.clock import bykc_timestamp
+from catalog import CatalogSnapshot
 from config import config
-from sqlalchemy import select
-from sqlalchemy.orm import Session
-from models import Course, engine
+from course_cache import CourseCache
+from metrics import metrics, DURATION_BUCKETS
+from offload import offload
+from outbox import outbox, PRIORITY_URGENT, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from polling import PollingPolicy
+from rush import RushEngine
+from storage import storage
+from models import Course
+from users import users, User
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
 
-client = Client(config.get('sso_username'), config.get('sso_password'))
+# the catalog is the same for every user, it is fetched by the primary user alone
+course_cache = CourseCache(users.primary.client)
+catalog = CatalogSnapshot(users.primary.client)
+polling = PollingPolicy()
+
+JOB_DURATION = metrics.histogram('job_duration_seconds', 'run time of the jobs', ('job',), DURATION_BUCKETS)
+HANDLER_ERRORS = metrics.counter('handler_errors_total', 'errors raised by the handlers and jobs, by exception type',
+                                 ('error',))
 
 
 class ReceivedCourseData:
-    def __init__(self):
+    # (user id, course id) -> (fingerprint of the received fields, status of the model) as of the last sync
+    fingerprints: Dict[Tuple[int, int], Tuple[int, int]] = {}
+
+    def __init__(self, user: User):
+        self.user = user
         self.id = None
         self.name = None
         self.teacher = None
@@ -45,6 +65,27 @@ class ReceivedCourseData:
         self.__notified = None
         self.__select_start_date_changed = False
         self.__status = None
+        self.__changed = False  # whether the last sync changed the model
+
+    @staticmethod
+    def from_course(course: dict, user: User, selected=None) -> 'ReceivedCourseData':
+        """
+        :param course: a course as listed by the api, without teacher and description
+        :param selected: overrides whether `user` has chosen the course
+        """
+        course_data = ReceivedCourseData(user)
+        course_data.id = course['id']
+        course_data.name = course['courseName']
+        course_data.position = course['coursePosition']
+        course_data.start_date = course['courseStartDate']
+        course_data.end_date = course['courseEndDate']
+        course_data.select_start_date = course['courseSelectStartDate']
+        course_data.select_end_date = course['courseSelectEndDate']
+        course_data.cancel_end_date = course['courseCancelEndDate']
+        course_data.current_count = course['courseCurrentCount']
+        course_data.max_count = course['courseMaxCount']
+        course_data.selected = user.is_chosen(course) if selected is None else selected
+        return course_data
 
     def sync_model(self):
         """
@@ -52,51 +93,105 @@ class ReceivedCourseData:
         after which we know `__is_notified`, `__is_select_start_date_changed`, `__status`
         :return:
         """
-        if self.__model_synced:
-            return
-        with Session(engine) as session:
-            stmt = select(Course).where(Course.id == self.id)
-            course: Course = session.execute(stmt).scalar()
-            start_date = self.start_date and datetime.datetime.strptime(self.start_date, '%Y-%m-%d %H:%M:%S')
-            end_date = self.end_date and datetime.datetime.strptime(self.end_date, '%Y-%m-%d %H:%M:%S')
-            select_start_date = self.select_start_date and datetime.datetime.strptime(self.select_start_date,
-                                                                                      '%Y-%m-%d %H:%M:%S')
-            select_end_date = self.select_end_date and datetime.datetime.strptime(self.select_end_date,
-                                                                                  '%Y-%m-%d %H:%M:%S')
-            cancel_end_date = self.cancel_end_date and datetime.datetime.strptime(self.cancel_end_date,
+        ReceivedCourseData.sync_models([self])
+
+    def fingerprint(self) -> int:
+        """
+        a hash of the fields that are synced with the model
+        """
+        return hash((self.name, self.start_date, self.end_date, self.select_start_date, self.select_end_date,
+                     self.cancel_end_date, bool(self.selected)))
+
+    @staticmethod
+    def sync_models(courses: List['ReceivedCourseData']) -> Dict[str, int]:
+        """
+        sync a batch of courses with the repository, and only then emit the status-change callbacks.
+        a course whose fingerprint and model status are the same as at its last sync is skipped,
+        a course without a fingerprint, e.g. after a restart, is applied but only counted as changed if it is
+        :return: how many courses are new, changed or unchanged
+        """
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        courses = [course_data for course_data in courses if not course_data.__model_synced]
+        if not courses:
+            return counts
+        changes = []
+        for course_data in courses:
+            model = course_data.user.repository.get(course_data.id)
+            key = (course_data.user.id, course_data.id)
+            fingerprint = course_data.fingerprint()
+            if model is not None and ReceivedCourseData.fingerprints.get(key) == (fingerprint, model.status):
+                counts['unchanged'] += 1
+                course_data.__notified = model.notified
+                course_data.__status = model.status
+            else:
+                new_status = course_data.__apply(model)
+                counts['new' if model is None else 'changed' if course_data.__changed else 'unchanged'] += 1
+                if new_status is not None:
+                    changes.append((course_data.user, course_data.id, new_status))
+                ReceivedCourseData.fingerprints[key] = (fingerprint, course_data.__status)
+            course_data.__model_synced = True
+        for user, course_id, new_status in changes:
+            on_course_status_changed(application, user, course_id, new_status)
+        return counts
+
+    @staticmethod
+    def prune_fingerprints(user: User, course_ids):
+        """
+        forget the fingerprints of the courses of `user` that are no longer listed
+        :param course_ids: the courses in the catalog
+        """
+        listed = set(course_ids)
+        for key in [key for key in ReceivedCourseData.fingerprints if key[0] == user.id and key[1] not in listed]:
+            del ReceivedCourseData.fingerprints[key]
+
+    def __apply(self, course: Optional[Course]) -> Optional[int]:
+        """
+        apply the received data to the model, or add a new model if `course` is None
+        :return: the new status if it is changed
+        """
+        start_date = self.start_date and datetime.datetime.strptime(self.start_date, '%Y-%m-%d %H:%M:%S')
+        end_date = self.end_date and datetime.datetime.strptime(self.end_date, '%Y-%m-%d %H:%M:%S')
+        select_start_date = self.select_start_date and datetime.datetime.strptime(self.select_start_date,
                                                                                   '%Y-%m-%d %H:%M:%S')
-            if course is None:
-                if self.selected:
-                    status = Course.STATUS_SELECTED
-                else:
-                    status = Course.STATUS_NOT_SELECTED
-                course = Course(id=self.id, name=self.name, start_date=start_date, end_date=end_date,
-                                select_start_date=select_start_date, select_end_date=select_end_date,
-                                cancel_end_date=cancel_end_date, status=status)
-                self.__notified = False
-                self.__status = status
-                session.add(course)
-                session.commit()
-                on_course_status_changed(application, self.id, status)
+        select_end_date = self.select_end_date and datetime.datetime.strptime(self.select_end_date,
+                                                                              '%Y-%m-%d %H:%M:%S')
+        cancel_end_date = self.cancel_end_date and datetime.datetime.strptime(self.cancel_end_date,
+                                                                              '%Y-%m-%d %H:%M:%S')
+        new_status = None
+        if course is None:
+            if self.selected:
+                status = Course.STATUS_SELECTED
             else:
-                course.name = self.name
-                course.start_date = start_date
-                course.end_date = end_date
-                if course.select_start_date != select_start_date:
-                    self.__select_start_date_changed = True
-                course.select_start_date = select_start_date
-                course.select_end_date = select_end_date
-                course.cancel_end_date = cancel_end_date
-                if self.selected and course.status not in [Course.STATUS_SELECTED, Course.STATUS_FINISHED]:
-                    course.status = Course.STATUS_SELECTED
-                    on_course_status_changed(application, self.id, course.status)
-                elif not self.selected and course.status in [Course.STATUS_SELECTED, Course.STATUS_FINISHED]:
-                    course.status = Course.STATUS_NOT_SELECTED
-                    on_course_status_changed(application, self.id, course.status)
-                session.commit()
-                self.__notified = course.notified
-                self.__status = course.status
-        self.__model_synced = True
+                status = Course.STATUS_NOT_SELECTED
+            course = Course(id=self.id, name=self.name, start_date=start_date, end_date=end_date,
+                            select_start_date=select_start_date, select_end_date=select_end_date,
+                            cancel_end_date=cancel_end_date, status=status, notified=False)
+            self.user.repository.add(course)
+            new_status = status
+        else:
+            old = (course.name, course.start_date, course.end_date, course.select_start_date, course.select_end_date,
+                   course.cancel_end_date, course.status)
+            course.name = self.name
+            course.start_date = start_date
+            course.end_date = end_date
+            if course.select_start_date != select_start_date:
+                self.__select_start_date_changed = True
+            course.select_start_date = select_start_date
+            course.select_end_date = select_end_date
+            course.cancel_end_date = cancel_end_date
+            if self.selected and course.status not in [Course.STATUS_SELECTED, Course.STATUS_FINISHED]:
+                course.status = Course.STATUS_SELECTED
+                new_status = course.status
+            elif not self.selected and course.status in [Course.STATUS_SELECTED, Course.STATUS_FINISHED]:
+                course.status = Course.STATUS_NOT_SELECTED
+                new_status = course.status
+            self.__changed = old != (course.name, course.start_date, course.end_date, course.select_start_date,
+                                     course.select_end_date, course.cancel_end_date, course.status)
+            if self.__changed:
+                self.user.repository.save(course)
+        self.__notified = course.notified
+        self.__status = course.status
+        return new_status
 
     def is_notified(self):
         if not self.__model_synced:
@@ -104,12 +199,18 @@ class ReceivedCourseData:
         return self.__notified
 
     def set_notified(self, value):
-        self.__notified = value
-        with Session(engine) as session:
-            stmt = select(Course).where(Course.id == self.id)
-            course: Course = session.execute(stmt).scalar()
+        ReceivedCourseData.set_notified_many([self], value)
+
+    @staticmethod
+    def set_notified_many(courses: List['ReceivedCourseData'], value):
+        """
+        set the notified flag of a batch of courses, they are written back together
+        """
+        for course_data in courses:
+            course_data.__notified = value
+            course = course_data.user.repository.get(course_data.id)
             course.notified = value
-            session.commit()
+            course_data.user.repository.save(course)
 
     def get_status(self):
         if not self.__model_synced:
@@ -121,7 +222,7 @@ class ReceivedCourseData:
             self.sync_model()
         return self.__select_start_date_changed
 
-    def get_info(self, is_detail, title=None):
+    def get_status_text(self):
         if not self.__model_synced:
             self.sync_model()
         if self.__status == Course.STATUS_NOT_SELECTED:
@@ -136,7 +237,18 @@ class ReceivedCourseData:
             status = "🟢已完成"
         else:
             status = "系统错误"
+        return status
+
+    def get_brief(self, index):
+        """
+        a compact entry of a course list
+        """
+        return f"{index}. {self.name}\n" \
+               f"      {self.start_date}｜{self.position}｜{self.current_count}/{self.max_count}｜" \
+               f"{self.get_status_text()}\n"
 
+    def get_info(self, is_detail, title=None):
+        status = self.get_status_text()
         if is_detail == "no":
             return (f"{title}\n" if title else "") + \
                 f"ID：{self.id}\n" \
@@ -164,7 +276,8 @@ class ReceivedCourseData:
 
     async def refresh(self):
         self.__model_synced = False
-        data = await client.query_course_by_id(self.id)
+        await self.user.ensure_chosen()
+        data, self.description = await course_cache.get(self.id)
         self.id = data['id']
         self.name = data['courseName']
         self.teacher = data['courseTeacher']
@@ -176,10 +289,12 @@ class ReceivedCourseData:
         self.cancel_end_date = data['courseCancelEndDate']
         self.current_count = data['courseCurrentCount']
         self.max_count = data['courseMaxCount']
-        self.selected = data['selected']
-        self.description = html_process.transform(data['courseDesc'])
+        self.selected = self.user.is_chosen(data)
 
-    def get_reply_markup(self, is_detail):
+    def get_reply_markup(self, is_detail, back_to_page=None):
+        """
+        :param back_to_page: add a button going back to this page of the course list
+        """
         keyboard = []
         if is_detail == "no":
             keyboard.append(InlineKeyboardButton("查看详情", callback_data=f'detail {self.id}'))
@@ -188,11 +303,124 @@ class ReceivedCourseData:
         else:
             keyboard.append(InlineKeyboardButton("我要退课", callback_data=f'cancel {self.id} {is_detail}'))
         keyboard = [keyboard]
+        if back_to_page is not None:
+            keyboard.append([InlineKeyboardButton("返回列表", callback_data=f'page {back_to_page}')])
         return InlineKeyboardMarkup(keyboard)
 
 
+### course list ###
+# the list sent by /query_avail or /query_chosen is one message showing a page of courses at a time,
+# it is kept in `chat_data['course_list']`: the title, the courses, the current page and the id of the message.
+# paging, and the details and actions of its courses, edit that same message
+
+def render_course_list(course_list: dict) -> Tuple[str, InlineKeyboardMarkup]:
+    page_size = int(config.get('list_page_size') or 5)
+    courses = course_list['courses']
+    pages = max(1, (len(courses) + page_size - 1) // page_size)
+    page = course_list['page'] = min(max(course_list['page'], 0), pages - 1)
+    first = page * page_size
+    text = f"{course_list['title']}第{page + 1}/{pages}页，共{len(courses)}门\n"
+    if course_list.get('fetched_at') is not None:
+        text += f"数据更新于{format_age(time.time() - course_list['fetched_at'])}\n"
+    text += "\n"
+    keyboard = []
+    for index, course_data in enumerate(courses[first:first + page_size], first + 1):
+        text += course_data.get_brief(index)
+        row = [InlineKeyboardButton(f"{index}.详情", callback_data=f'detail {course_data.id}')]
+        if course_data.get_status() == Course.STATUS_NOT_SELECTED:
+            row.append(InlineKeyboardButton(f"{index}.选课", callback_data=f'choose {course_data.id} list'))
+        else:
+            row.append(InlineKeyboardButton(f"{index}.退课", callback_data=f'cancel {course_data.id} list'))
+        keyboard.append(row)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("上一页", callback_data=f'page {page - 1}'))
+    if page < pages - 1:
+        navigation.append(InlineKeyboardButton("下一页", callback_data=f'page {page + 1}'))
+    if navigation:
+        keyboard.append(navigation)
+    if course_list.get('fetched_at') is not None:
+        keyboard.append([InlineKeyboardButton("刷新", callback_data='refresh_list')])
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def format_age(seconds: float) -> str:
+    if seconds < 60:
+        return "刚刚"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}分钟前"
+    return f"{int(seconds // 3600)}小时前"
+
+
+def format_duration(seconds: float) -> str:
+    days, seconds = divmod(int(seconds), 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes = seconds // 60
+    if days:
+        return f"{days}天{hours}小时"
+    if hours:
+        return f"{hours}小时{minutes}分钟"
+    if minutes:
+        return f"{minutes}分钟"
+    return "不到1分钟"
+
+
+async def send_course_list(update: Update, context: ContextTypes.DEFAULT_TYPE, title: str,
+                           courses: List[ReceivedCourseData], fetched_at: float = None):
+    """
+    :param fetched_at: when the courses were fetched if they come from the catalog snapshot,
+    the list then shows how old it is and can be refreshed
+    """
+    if len(courses) == 0:
+        await outbox.call(update.effective_chat.id, PRIORITY_INTERACTIVE, update.message.reply_text, "未查询到")
+        return
+    ReceivedCourseData.sync_models(courses)
+    course_list = {'title': title, 'courses': courses, 'page': 0, 'message_id': None, 'fetched_at': fetched_at}
+    message, reply_markup = render_course_list(course_list)
+    sent = await outbox.call(update.effective_chat.id, PRIORITY_INTERACTIVE, update.message.reply_text, message,
+                             reply_markup=reply_markup)
+    course_list['message_id'] = sent.message_id
+    context.chat_data['course_list'] = course_list
+
+
+def get_course_list(context: ContextTypes.DEFAULT_TYPE, message) -> Optional[dict]:
+    """
+    :return: the course list shown in `message`, None if `message` is not the latest course list
+    """
+    course_list = context.chat_data.get('course_list')
+    if course_list is None or course_list['message_id'] != message.message_id:
+        return None
+    return course_list
+
+
+def update_course_list(context: ContextTypes.DEFAULT_TYPE, course_data: ReceivedCourseData):
+    """
+    replace the entry of a course in the course list with fresher data
+    """
+    course_list = context.chat_data.get('course_list')
+    if course_list is None:
+        return
+    for i, entry in enumerate(course_list['courses']):
+        if entry.id == course_data.id:
+            course_list['courses'][i] = course_data
+
+
 ### callbacks ###
 
+def with_user(handler):
+    """
+    pass the user sending the update to the handler as its third argument, reject those who are not users
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = users.get(update.effective_user.id)
+        if user is None:
+            await reject(update, context)
+            return
+        await handler(update, context, user)
+    return wrapper
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logging.info(f"handler called: start")
     message = "你好呀~我是北航博雅课程小助手喵！我可以帮你完成以下操作：\n" \
@@ -200,81 +428,133 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
               "/query_chosen 查询已选课程\n\n" \
               "/preferences 修改偏好配置\n\n" \
               "/status 查看系统当前运行状态"
-    await update.message.reply_text(message)
+    await outbox.call(update.effective_chat.id, PRIORITY_INTERACTIVE, update.message.reply_text, message)
 
 
-async def query_avail(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Displays what courses are available for selection."""
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Displays the metrics of the bot."""
+    logging.info(f"handler called: status")
+    lines = [f"【运行状态】", f"已运行{format_duration(metrics.uptime())}"] + metrics.summary()
+    message = '\n'.join(lines)
+    if len(message) > 4000:  # the limit of a telegram message is 4096
+        message = message[:4000] + '\n……'
+    await outbox.call(update.effective_chat.id, PRIORITY_INTERACTIVE, update.message.reply_text, message,
+                      parse_mode=None)
+
+
+@with_user
+async def query_avail(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
+    """Displays what courses are available for selection, from the catalog snapshot."""
     logging.info(f"handler called: query_avail")
-    resp = await client.query_student_semester_course_by_page(1, 20)
-    tasks = []
-    for course in resp['content']:
-        course_data = ReceivedCourseData()
-        course_data.id = course['id']
-        course_data.name = course['courseName']
-        course_data.position = course['coursePosition']
-        course_data.start_date = course['courseStartDate']
-        course_data.end_date = course['courseEndDate']
-        course_data.select_start_date = course['courseSelectStartDate']
-        course_data.select_end_date = course['courseSelectEndDate']
-        course_data.cancel_end_date = course['courseCancelEndDate']
-        if datetime.datetime.now() > datetime.datetime.strptime(course_data.select_end_date, '%Y-%m-%d %H:%M:%S'):
-            continue
-        course_data.current_count = course['courseCurrentCount']
-        course_data.max_count = course['courseMaxCount']
-        course_data.selected = course['selected']
-        message = course_data.get_info(is_detail="no")
-        reply_markup = course_data.get_reply_markup("no")
-        task = context.application.create_task(update.message.reply_text(message, reply_markup=reply_markup))
-        tasks.append(task)
-    await asyncio.gather(*tasks)
-    if len(tasks) == 0:
-        await update.message.reply_text("未查询到")
+    listed = await catalog.get()
+    await user.ensure_chosen()
+    courses = [ReceivedCourseData.from_course(course, user) for course in listed]
+    await send_course_list(update, context, "【可选课程】", courses, catalog.fetched_at)
 
 
-async def query_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user
+async def query_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
     """Displays what courses are chosen."""
     logging.info(f"handler called: query_chosen")
-    resp = await client.query_chosen_course()
-    tasks = []
-    for course in resp['courseList']:
-        course = course['courseInfo']
-        course_data = ReceivedCourseData()
-        course_data.id = course['id']
-        course_data.name = course['courseName']
-        course_data.position = course['coursePosition']
-        course_data.start_date = course['courseStartDate']
-        course_data.end_date = course['courseEndDate']
-        course_data.select_start_date = course['courseSelectStartDate']
-        course_data.select_end_date = course['courseSelectEndDate']
-        course_data.cancel_end_date = course['courseCancelEndDate']
-        course_data.current_count = course['courseCurrentCount']
-        course_data.max_count = course['courseMaxCount']
-        course_data.selected = True
-        message = course_data.get_info(is_detail="no")
-        reply_markup = course_data.get_reply_markup("no")
-        task = context.application.create_task(update.message.reply_text(message, reply_markup=reply_markup))
-        tasks.append(task)
-    await asyncio.gather(*tasks)
-    if len(tasks) == 0:
-        await update.message.reply_text("未查询到")
+    courses = [ReceivedCourseData.from_course(course, user, selected=True) for course in await user.sync_chosen()]
+    await send_course_list(update, context, "【已选课程】", courses)
 
 
-async def detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Turns to a page of the course list."""
+    logging.info(f"handler called: page")
+    query = update.callback_query
+    course_list = get_course_list(context, query.message)
+    if course_list is None:
+        await outbox.call(None, PRIORITY_INTERACTIVE, query.answer, "列表已过期，请重新查询")
+        return
+    course_list['page'] = int(query.data.split(' ')[1])
+    message, reply_markup = render_course_list(course_list)
+    await asyncio.gather(outbox.call(None, PRIORITY_INTERACTIVE, query.answer),
+                         outbox.call(query.message.chat_id, PRIORITY_INTERACTIVE, query.message.edit_text, message,
+                                     reply_markup=reply_markup))
+
+
+@with_user
+async def refresh_list(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
+    """Fetches the catalog again and shows it in the course list."""
+    logging.info(f"handler called: refresh_list")
+    query = update.callback_query
+    course_list = get_course_list(context, query.message)
+    if course_list is None:
+        await outbox.call(None, PRIORITY_INTERACTIVE, query.answer, "列表已过期，请重新查询")
+        return
+    listed = await catalog.refresh()
+    await user.ensure_chosen()
+    courses = [ReceivedCourseData.from_course(course, user) for course in listed]
+    ReceivedCourseData.sync_models(courses)
+    course_list['courses'] = courses
+    course_list['fetched_at'] = catalog.fetched_at
+    message, reply_markup = render_course_list(course_list)
+    await asyncio.gather(outbox.call(None, PRIORITY_INTERACTIVE, query.answer, "已刷新"),
+                         outbox.call(query.message.chat_id, PRIORITY_INTERACTIVE, query.message.edit_text, message,
+                                     reply_markup=reply_markup))
+
+
+@with_user
+async def detail(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
     """Displays detail of a course."""
     logging.info(f"handler called: detail")
     query = update.callback_query
     course_id = int(query.data.split(' ')[1])
-    course_data = ReceivedCourseData()
+    course_data = ReceivedCourseData(user)
     course_data.id = course_id
     await course_data.refresh()
+    course_list = get_course_list(context, query.message)
     message = course_data.get_info(is_detail="yes")
-    reply_markup = course_data.get_reply_markup("yes")
-    await asyncio.gather(query.answer(),
-                         query.message.edit_text(message, reply_markup=reply_markup))
+    reply_markup = course_data.get_reply_markup("yes", course_list and course_list['page'])
+    await asyncio.gather(outbox.call(None, PRIORITY_INTERACTIVE, query.answer),
+                         outbox.call(query.message.chat_id, PRIORITY_INTERACTIVE, query.message.edit_text, message,
+                                     reply_markup=reply_markup))
+
+
+def record_selected(user: User, course_id: int, selected: bool, current_count=None):
+    """
+    patch the cached copies of a course after it is chosen or cancelled,
+    so that they cannot roll its status back when they are synced with the repository.
+    the cached `selected` is that of the primary user, the others keep their chosen courses themselves
+    """
+    fields = {}
+    if user.primary:
+        fields['selected'] = selected
+    else:
+        user.record_chosen(course_id, selected)
+    if current_count is not None:
+        fields['courseCurrentCount'] = current_count
+    course_cache.update(course_id, **fields)
+    catalog.update(course_id, **fields)
+
+
+async def show_course_after_action(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User, course_id: int,
+                                   is_detail, current_count):
+    """
+    edit the message the action is taken from: the course itself, or the page of the course list
+    """
+    course_data = ReceivedCourseData(user)
+    course_data.id = course_id
+    await course_data.refresh()
+    if current_count is not None:
+        course_data.current_count = current_count
+    update_course_list(context, course_data)
+    course_list = get_course_list(context, update.callback_query.message)
+    if is_detail == "list" and course_list is not None:
+        message, reply_markup = render_course_list(course_list)
+    else:
+        if is_detail == "list":  # the list is gone, show the course alone
+            is_detail = "no"
+        message = course_data.get_info(is_detail=is_detail)
+        reply_markup = course_data.get_reply_markup(is_detail, course_list and course_list['page'])
+    outbox.post(update.callback_query.message.chat_id, PRIORITY_INTERACTIVE, update.callback_query.message.edit_text,
+                message, reply_markup=reply_markup)
 
 
-async def choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user
+async def choose(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
     """Choose a course."""
     logging.info(f"handler called: choose")
     query = update.callback_query
@@ -282,287 +562,411 @@ async def choose(update: Update, context: ContextTypes.DEFAULT_TYPE):
     course_id = int(course_id)
     current_count = None
     try:
-        resp = await client.chose_course(course_id)
-        context.application.create_task(query.answer("选课成功"))
+        resp = await user.client.chose_course(course_id)
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "选课成功")
         current_count = resp['courseCurrentCount']
+        record_selected(user, course_id, True, current_count)
     except TooEarlyToChoose:
-        with Session(engine) as session:
-            course = session.query(Course).filter(Course.id == course_id).first()
-            course.status = Course.STATUS_BOOKED
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
-            context.application.create_task(query.answer("还未开始，预约选课成功"))
+        course = user.repository.get(course_id)
+        course.status = Course.STATUS_BOOKED
+        user.repository.save(course)
+        on_course_status_changed(context.application, user, course.id, course.status)
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "还未开始，预约选课成功")
     except CourseIsFull:
-        with Session(engine) as session:
-            course = session.query(Course).filter(Course.id == course_id).first()
-            if course.cancel_end_date > datetime.datetime.now() and course.select_end_date > datetime.datetime.now():
-                course.status = Course.STATUS_WAITING
-                session.commit()
-                on_course_status_changed(context.application, course.id, course.status)
-                context.application.create_task(query.answer("课程已满，预约补选成功"))
-            else:
-                context.application.create_task(query.answer("课程已满，选课失败"))
+        course = user.repository.get(course_id)
+        if course.cancel_end_date > datetime.datetime.now() and course.select_end_date > datetime.datetime.now():
+            course.status = Course.STATUS_WAITING
+            user.repository.save(course)
+            on_course_status_changed(context.application, user, course.id, course.status)
+            outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "课程已满，预约补选成功")
+        else:
+            outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "课程已满，选课失败")
     except AlreadyChosen:
-        context.application.create_task(query.answer("选课失败:已经选过该课程"))
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "选课失败:已经选过该课程")
     except FailedToChoose as e:
-        context.application.create_task(query.answer("选课失败:" + str(e)))
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "选课失败:" + str(e))
     except ApiException:
-        context.application.create_task(query.message.reply_text("选课失败:原因未知"))
-    course_data = ReceivedCourseData()
-    course_data.id = course_id
-    await course_data.refresh()
-    course_data.current_count = current_count
-    message = course_data.get_info(is_detail=is_detail)
-    reply_markup = course_data.get_reply_markup(is_detail)
-    context.application.create_task(update.callback_query.message.edit_text(message, reply_markup=reply_markup))
+        outbox.post(query.message.chat_id, PRIORITY_INTERACTIVE, query.message.reply_text, "选课失败:原因未知")
+    await show_course_after_action(update, context, user, course_id, is_detail, current_count)
 
 
-async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@with_user
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, user: User):
     """cancel a course"""
     logging.info(f"handler called: cancel")
     query = update.callback_query
     course_id, is_detail = query.data.split(' ')[1:]
     course_id = int(course_id)
     current_count = None
-    with Session(engine) as session:
-        course = session.query(Course).filter(Course.id == course_id).scalar()
-        if course.status in [Course.STATUS_BOOKED, Course.STATUS_WAITING]:
-            course.status = Course.STATUS_NOT_SELECTED
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
+    course = user.repository.get(course_id)
+    if course.status in [Course.STATUS_BOOKED, Course.STATUS_WAITING]:
+        course.status = Course.STATUS_NOT_SELECTED
+        user.repository.save(course)
+        on_course_status_changed(context.application, user, course.id, course.status)
     try:
-        resp = await client.del_chosen_course(course_id)
+        resp = await user.client.del_chosen_course(course_id)
         current_count = resp['courseCurrentCount']
-        context.application.create_task(query.answer("退课成功"))
+        record_selected(user, course_id, False, current_count)
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "退课成功")
     except FailedToDelChosen as e:
-        context.application.create_task(query.answer("退课失败:" + str(e)))
-    course_data = ReceivedCourseData()
-    course_data.id = course_id
-    await course_data.refresh()
-    course_data.current_count = current_count
-    message = course_data.get_info(is_detail=is_detail)
-    reply_markup = course_data.get_reply_markup(is_detail)
-    context.application.create_task(update.callback_query.message.edit_text(message, reply_markup=reply_markup))
+        outbox.post(None, PRIORITY_INTERACTIVE, query.answer, "退课失败:" + str(e))
+    await show_course_after_action(update, context, user, course_id, is_detail, current_count)
 
 
 async def reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reject the current user"""
-    await update.message.reply_text(f"您的id是{update.effective_user.id}，您没有权限使用本机器人。\n"
-                                    f"如果该机器人是您的，请在config.json中填入您的id。")
+    if update.callback_query is not None:
+        await outbox.call(None, PRIORITY_INTERACTIVE, update.callback_query.answer, "您没有权限使用本机器人")
+        return
+    await outbox.call(update.effective_chat.id, PRIORITY_INTERACTIVE, update.message.reply_text,
+                      f"您的id是{update.effective_user.id}，您没有权限使用本机器人。\n"
+                      f"如果该机器人是您的，请在config.json中填入您的id。")
 
 
 ### jobs ###
 
+last_sync_counts: Dict[str, int] = {}  # of the last run of the refresh job, summed over the users
+
+
+@metrics.timed(JOB_DURATION, job='refresh_course_list')
 async def refresh_course_list(context: ContextTypes.DEFAULT_TYPE):
-    """Refresh the course list"""
-    resp = await client.query_student_semester_course_by_page(1, 20)
-    for course in resp['content']:
-        course_data = ReceivedCourseData()
-        course_data.id = course['id']
-        course_data.name = course['courseName']
-        course_data.position = course['coursePosition']
-        course_data.start_date = course['courseStartDate']
-        course_data.end_date = course['courseEndDate']
-        course_data.select_start_date = course['courseSelectStartDate']
-        course_data.select_end_date = course['courseSelectEndDate']
-        course_data.cancel_end_date = course['courseCancelEndDate']
-        if datetime.datetime.now() > datetime.datetime.strptime(course_data.select_end_date, '%Y-%m-%d %H:%M:%S'):
+    """Refresh the course list: the catalog is fetched once, then synced with the courses of every user"""
+    listed = await catalog.refresh()
+    await users.sync_chosen()
+    courses = []
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+    for user in users:
+        if not user.knows_chosen():  # its selected courses would be taken as cancelled
+            logging.warning(f'skip refreshing the courses of user {user.id}, its chosen courses are unknown')
             continue
-        course_data.current_count = course['courseCurrentCount']
-        course_data.max_count = course['courseMaxCount']
-        course_data.selected = course['selected']
-        course_data.sync_model()
-        if course_data.is_select_start_date_changed() and course_data.get_status() == Course.STATUS_BOOKED:
-            add_rush_job(context.job_queue, course_data.id,
-                         datetime.datetime.strptime(course_data.select_start_date, '%Y-%m-%d %H:%M:%S'))
-        if not course_data.is_notified():
-            message = course_data.get_info(is_detail="no", title='【新的博雅】')
-            reply_markup = course_data.get_reply_markup("no")
-            try:
-                await context.bot.send_message(
-                    config.get('telegram_owner_id'), message, reply_markup=reply_markup)
-                course_data.set_notified(True)
-            except:
-                # retry in 10 seconds
-                for job in context.job_queue.get_jobs_by_name('refresh_retry'):
-                    job.schedule_removal()  # prevent job blood
-                context.job_queue.run_once(refresh_course_list, 10, name='refresh_retry')
+        user_courses = [ReceivedCourseData.from_course(course, user) for course in listed]
+        for change, count in ReceivedCourseData.sync_models(user_courses).items():
+            counts[change] += count
+        ReceivedCourseData.prune_fingerprints(user, (course['id'] for course in listed))
+        courses += user_courses
+    last_sync_counts.update(counts)
+    logging.info(f"refresh course list: {counts['new']} new, {counts['changed']} changed, "
+                 f"{counts['unchanged']} unchanged")
+    course_cache.prefetch({course_data.id for course_data in courses if not course_data.is_notified()})
+    notified = []
+    try:
+        for course_data in courses:
+            if course_data.is_select_start_date_changed() and course_data.get_status() == Course.STATUS_BOOKED:
+                add_rush_job(context.job_queue, course_data.user, course_data.id,
+                             datetime.datetime.strptime(course_data.select_start_date, '%Y-%m-%d %H:%M:%S'))
+            if not course_data.is_notified():
+                message = course_data.get_info(is_detail="no", title='【新的博雅】')
+                reply_markup = course_data.get_reply_markup("no")
+                try:
+                    await outbox.send_message(context.bot, course_data.user.id, message, PRIORITY_BULK,
+                                              reply_markup=reply_markup)
+                    notified.append(course_data)
+                except TelegramError:
+                    # the outbox has already retried flood waits and network errors, retry in 10 seconds
+                    for job in context.job_queue.get_jobs_by_name('refresh_retry'):
+                        job.schedule_removal()  # prevent job blood
+                    context.job_queue.run_once(refresh_course_list, 10, name='refresh_retry')
+    finally:
+        ReceivedCourseData.set_notified_many(notified, True)
+
 
+waitlist_stats = {'polls': 0, 'full': 0, 'attempts': 0, 'selected': 0}
 
+
+@metrics.timed(JOB_DURATION, job='wait_for_others_cancellation')
 async def wait_for_others_cancellation(context: ContextTypes.DEFAULT_TYPE):
-    with Session(engine) as session:
-        courses = session.query(Course).filter(Course.status == Course.STATUS_WAITING).all()
-        for course in courses:
-            course_id = course.id
-            if datetime.datetime.now() < course.select_end_date:
-                try:
-                    await client.chose_course(course_id)
-                    course.status = Course.STATUS_SELECTED
-                    session.commit()
-                    on_course_status_changed(context.application, course.id, course.status)
-                    keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
-                                 InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await context.bot.send_message(config.get('telegram_owner_id'), f"【补选成功】\n{course.name}",
-                                                   reply_markup=reply_markup)
-                    continue
-                except ApiException:
-                    if course.cancel_end_date >= datetime.datetime.now():
-                        continue
-            course.status = Course.STATUS_NOT_SELECTED
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
-            keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
-                         InlineKeyboardButton("我要选课", callback_data=f'choose {course_id} no')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(config.get('telegram_owner_id'), f"【补选失败】\n{course.name}",
-                                           reply_markup=reply_markup)
-
-
-def add_rush_job(job_queue, course_id, select_start_date: datetime.datetime):
-    job_name = f'rush_select_{course_id}'
+    """
+    poll the waiting courses of every user: read their capacities from one catalog poll,
+    which only fetches the pages they are listed on, and only try to choose those with a free seat, a few at a time
+    """
+    waiting = [(user, course) for user in users for course in user.repository.with_status(Course.STATUS_WAITING)]
+    if not waiting:
+        return
+    waitlist_stats['polls'] += 1
+    now = datetime.datetime.now()
+    capacities = {}
+    selectable = {course.id for _, course in waiting if now < course.select_end_date}
+    if selectable:
+        try:
+            # a snapshot refreshed since the shortest poll interval is fresh enough
+            capacities = await catalog.poll(selectable, polling.waitlist_min)
+        except ApiException as e:
+            logging.warning(f'failed to read the capacities of the waiting courses, trying them all: {e!r}')
+    semaphore = asyncio.Semaphore(int(config.get('waitlist_concurrency') or 4))
+    await asyncio.gather(*[__poll_waiting_course(context, user, course, capacities.get(course.id), now, semaphore)
+                           for user, course in waiting])
+
+
+async def __poll_waiting_course(context: ContextTypes.DEFAULT_TYPE, user: User, course: Course,
+                                listed: Optional[dict], now: datetime.datetime, semaphore: asyncio.Semaphore):
+    """
+    :param listed: the course as listed in the catalog, None if it is not listed
+    """
+    course_id = course.id
+    if now < course.select_end_date:
+        if listed is not None and listed['courseCurrentCount'] >= listed['courseMaxCount']:
+            waitlist_stats['full'] += 1
+            if course.cancel_end_date >= now:
+                return
+        else:
+            try:
+                async with semaphore:
+                    waitlist_stats['attempts'] += 1
+                    await user.client.chose_course(course_id)
+                waitlist_stats['selected'] += 1
+                record_selected(user, course_id, True)
+                course.status = Course.STATUS_SELECTED
+                user.repository.save(course)
+                on_course_status_changed(context.application, user, course.id, course.status)
+                keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
+                             InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                await outbox.send_message(context.bot, user.id, f"【补选成功】\n{course.name}",
+                                          PRIORITY_URGENT, reply_markup=reply_markup)
+                return
+            except ApiException:
+                if course.cancel_end_date >= now:
+                    return
+    course.status = Course.STATUS_NOT_SELECTED
+    user.repository.save(course)
+    on_course_status_changed(context.application, user, course.id, course.status)
+    keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
+                 InlineKeyboardButton("我要选课", callback_data=f'choose {course_id} no')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await outbox.send_message(context.bot, user.id, f"【补选失败】\n{course.name}",
+                              PRIORITY_URGENT, reply_markup=reply_markup)
+
+
+def schedule_poll(job_queue, callback, name: str, delay: float):
+    """
+    (re)schedule a polling job to run once after `delay` seconds, it schedules its next run itself
+    """
+    for job in job_queue.get_jobs_by_name(name):
+        job.schedule_removal()
+    job_queue.run_once(callback, delay, name=name)
+
+
+def schedule_refresh(job_queue):
+    delay = polling.refresh_delay([course for user in users for course in user.repository.all()],
+                                  datetime.datetime.now())
+    logging.debug(f'next refresh in {delay:.0f}s')
+    schedule_poll(job_queue, poll_refresh, 'refresh', delay)
+
+
+# a poll reschedules itself when it finishes, a reschedule asked for meanwhile must not start another one beside it
+waitlist_poll = {'running': False, 'reschedule': False}
+
+
+def schedule_waitlist(job_queue):
+    if waitlist_poll['running']:
+        waitlist_poll['reschedule'] = True
+        return
+    delay = polling.waitlist_delay([course for user in users for course in user.repository.with_status(
+        Course.STATUS_WAITING)], datetime.datetime.now())
+    logging.debug(f'next waitlist poll in {delay:.0f}s')
+    schedule_poll(job_queue, poll_waitlist, 'wait_for_others_cancellation', delay)
+
+
+async def poll_refresh(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        await refresh_course_list(context)
+    finally:
+        schedule_refresh(context.job_queue)
+
+
+async def poll_waitlist(context: ContextTypes.DEFAULT_TYPE):
+    waitlist_poll['running'] = True
+    try:
+        await wait_for_others_cancellation(context)
+    finally:
+        waitlist_poll['running'] = False
+        if waitlist_poll['reschedule']:
+            logging.debug('courses started waiting during the waitlist poll')
+        waitlist_poll['reschedule'] = False
+        schedule_waitlist(context.job_queue)  # from the courses waiting now, those added during the poll included
+
+
+# the running rush plans by the user and their opening instant
+rush_plans: Dict[Tuple[int, datetime.datetime], RushEngine] = {}
+
+
+def rush_priority(user: User, course_id) -> int:
+    """
+    courses booked earlier have higher priority in a rush plan
+    """
+    priority = storage.get(user.storage_key('rush_priority')) or []
+    return priority.index(course_id) if course_id in priority else len(priority)
+
+
+@metrics.timed(JOB_DURATION, job='keep_token_fresh')
+async def keep_token_fresh(context: ContextTypes.DEFAULT_TYPE):
+    pool = list(users)
+    results = await asyncio.gather(*[user.token_manager.maintain() for user in pool], return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    for user, result in zip(pool, results):
+        if isinstance(result, Exception):
+            logging.warning(f'failed to keep the token of user {user.id} fresh: {result!r}')
+    if errors:
+        raise errors[0]
+
+
+def add_rush_job(job_queue, user: User, course_id, select_start_date: datetime.datetime):
+    """
+    all the courses of a user opening at the same instant share one rush job
+    """
+    rush = rush_plans.get((user.id, select_start_date))
+    if rush is not None and rush.add_course(course_id):
+        user.client.prepare_chose_course(course_id, int(config.get('envelope_pool_size') or 40))
+        return
+    job_name = f'rush_select_{user.id}_{select_start_date:%Y%m%d%H%M%S}'
     for exist in job_queue.get_jobs_by_name(job_name):
         exist.schedule_removal()
-    select_date = select_start_date - datetime.timedelta(seconds=60)
+    # the clock offset is known from earlier api calls
+    select_date = select_start_date - datetime.timedelta(seconds=60 + user.client.clock.offset)
     if datetime.datetime.now() > select_date:
-        job_queue.run_once(rush_select, 0, name=job_name, data=course_id, job_kwargs={
+        job_queue.run_once(rush_select, 0, name=job_name, data=(user.id, select_start_date), job_kwargs={
             'misfire_grace_time': None  # no matter how late, run it immediately
         })
     else:
-        job_queue.run_once(rush_select, select_date, name=job_name, data=course_id, job_kwargs={
+        job_queue.run_once(rush_select, select_date, name=job_name, data=(user.id, select_start_date), job_kwargs={
             'misfire_grace_time': None  # no matter how late, run it immediately
         })
 
 
-async def __rush_select_one(course_id, finish_event: asyncio.Future):
+async def __ensure_fresh_token(user: User):
+    """
+    a failed check of the token must never cancel a rush, its attempts login again themselves if it is expired
+    """
     try:
-        result = await client.chose_course(course_id)
-        logging.info("Success: " + json.dumps(result))
-        if not finish_event.done():
-            finish_event.set_result(True)
-    except AlreadyChosen as e:
-        logging.info("Success: " + repr(e))
-        if not finish_event.done():
-            finish_event.set_result(True)
-    except CourseIsFull as e:
-        logging.info("FailAndExit: " + repr(e))
-        if not finish_event.done():
-            finish_event.set_exception(e)
-    except Exception as e:
-        logging.info("Fail: " + repr(e))
-        pass
-
-
-async def __rush_select_generator(course_id,
-                                  select_start_date: datetime.datetime,
-                                  finish_event: asyncio.Future):
-    TIMEOUT = datetime.timedelta(seconds=60)
-    RETRY_INTERVAL = 0.5
-    now = datetime.datetime.now()
-    select_date = select_start_date - datetime.timedelta(seconds=10)
-    if now < select_date:
-        await asyncio.sleep((select_date - now).total_seconds())
-    while not finish_event.done() and datetime.datetime.now() < select_start_date + TIMEOUT:
-        asyncio.create_task(__rush_select_one(course_id, finish_event))
-        await asyncio.sleep(RETRY_INTERVAL)
-    if not finish_event.done():
-        finish_event.set_exception(TimeoutError())
-
-
-def __rush_select(course_id, select_start_date: datetime.datetime):
-    future = asyncio.Future()
-    asyncio.create_task(__rush_select_generator(course_id, select_start_date, future))
-    return future
+        await user.token_manager.ensure_fresh()
+    except ApiException as e:
+        logging.warning(f'failed to refresh the token of user {user.id} before a rush, rush anyway: {e!r}')
+
+
+async def __rush_select(user: User, rush: RushEngine):
+    """
+    get the connections, the clock and the envelopes ready, then run the rush engine
+    """
+    await __ensure_fresh_token(user)
+    await user.client.sync_clock()
+    wake_at = rush.fire_at() - 10
+    if time.time() < wake_at:
+        await asyncio.sleep(wake_at - time.time())
+    await __ensure_fresh_token(user)
+    await rush.prepare()
+    logging.info(f"rush select {rush.course_ids} of user {user.id}: first attempt in "
+                 f"{rush.start_at() - time.time():.3f}s, {user.client.clock.summary()}")
+    try:
+        await rush.run()
+    finally:
+        rush.discard()
+        rush.log_timeline()
 
 
+@metrics.timed(JOB_DURATION, job='rush_select')
 async def rush_select(context: ContextTypes.DEFAULT_TYPE):
-    course_id = context.job.data
-    with Session(engine) as session:
-        course = session.query(Course).filter(Course.id == course_id).scalar()
+    user_id, select_start_date = context.job.data
+    user = users.get(user_id)
+    if user is None or (user_id, select_start_date) in rush_plans:
+        return
+    courses = [course for course in user.repository.with_status(Course.STATUS_BOOKED)
+               if course.select_start_date == select_start_date]
+    if not courses:
+        return
+    courses.sort(key=lambda c: rush_priority(user, c.id))
+    names = '\n'.join(course.name for course in courses)
+    outbox.post(user.id, PRIORITY_INTERACTIVE, context.bot.send_message, user.id, f"【抢选即将开始】\n{names}")
+    rush = RushEngine(user.client, [course.id for course in courses], bykc_timestamp(select_start_date))
+    rush_plans[(user_id, select_start_date)] = rush
+    try:
+        await __rush_select(user, rush)
+    finally:
+        del rush_plans[(user_id, select_start_date)]
+        logging.info(f"rush select {rush.course_ids} of user {user.id} finished, {rush.summary()}, "
+                     f"connection pool: {user.client.pool_stats()}, {user.client.clock.summary()}, "
+                     f"token: {user.token_manager.freshness()}")
+    for course_id, result in rush.results.items():
+        course = user.repository.get(course_id)
         if course.status != Course.STATUS_BOOKED:
-            return
-        context.application.create_task(
-            context.bot.send_message(config.get('telegram_owner_id'), f"【抢选即将开始】\n{course.name}")
-        )
-        select_start_date = course.select_start_date
-        try:
-            await __rush_select(course_id, select_start_date)
+            continue
+        if result is None:
+            record_selected(user, course_id, True)
             course.status = Course.STATUS_SELECTED
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
-            keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
-                         InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(config.get('telegram_owner_id'), f"【抢选成功】\n{course.name}",
-                                           reply_markup=reply_markup)
-        except CourseIsFull:
+            title = "【抢选成功】"
+        elif isinstance(result, CourseIsFull):
             course.status = Course.STATUS_WAITING
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
-            keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
-                         InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(config.get('telegram_owner_id'),
-                                           f"【抢选失败：课程已满】\n{course.name}\n已自动进入补选模式",
-                                           reply_markup=reply_markup)
-        except TimeoutError:
+            title = "【抢选失败：课程已满】"
+        else:
             course.status = Course.STATUS_WAITING
-            session.commit()
-            on_course_status_changed(context.application, course.id, course.status)
-            keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
-                         InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await context.bot.send_message(config.get('telegram_owner_id'),
-                                           f"【抢选失败：超时】\n{course.name}\n已自动进入补选模式",
-                                           reply_markup=reply_markup)
-
-
-def add_remind_job(job_queue, course_id, start_date: datetime.datetime):
-    job_name = f'remind_{course_id}'
+            title = "【抢选失败：超时】"
+        user.repository.save(course)
+        on_course_status_changed(context.application, user, course.id, course.status)
+        keyboard = [[InlineKeyboardButton("查看详情", callback_data=f'detail {course_id}'),
+                     InlineKeyboardButton("我要退课", callback_data=f'cancel {course_id} no')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        message = f"{title}\n{course.name}\n"
+        if course.status == Course.STATUS_WAITING:
+            message += "已自动进入补选模式\n"
+        message += f"{rush.summary(course_id)}\n{user.client.clock.summary()}"
+        await outbox.send_message(context.bot, user.id, message, PRIORITY_URGENT, reply_markup=reply_markup)
+
+
+def add_remind_job(job_queue, user: User, course_id, start_date: datetime.datetime):
+    job_name = f'remind_{user.id}_{course_id}'
     remind_date = start_date - datetime.timedelta(minutes=20)
     for exist in job_queue.get_jobs_by_name(job_name):
         exist.schedule_removal()
     if datetime.datetime.now() > remind_date:
-        job_queue.run_once(remind, 0, name=job_name, data=course_id, job_kwargs={
+        job_queue.run_once(remind, 0, name=job_name, data=(user.id, course_id), job_kwargs={
             'misfire_grace_time': None  # no matter how late, run it immediately
         })
     else:
-        job_queue.run_once(remind, remind_date, name=job_name, data=course_id, job_kwargs={
+        job_queue.run_once(remind, remind_date, name=job_name, data=(user.id, course_id), job_kwargs={
             'misfire_grace_time': None  # no matter how late, run it immediately
         })
 
 
+@metrics.timed(JOB_DURATION, job='remind')
 async def remind(context: ContextTypes.DEFAULT_TYPE):
-    course_id = context.job.data
-    with Session(engine) as session:
-        course = session.query(Course).filter(Course.id == course_id).scalar()
-        if course.status != Course.STATUS_SELECTED:
-            return
-        await context.bot.send_message(config.get('telegram_owner_id'), f"【课程即将开始】\n{course.name}")
-        course.status = Course.STATUS_FINISHED
-        session.commit()
-        on_course_status_changed(context.application, course.id, course.status)
-
-
-def on_course_status_changed(application, course_id, new_status):
+    user_id, course_id = context.job.data
+    user = users.get(user_id)
+    course = user and user.repository.get(course_id)
+    if course is None or course.status != Course.STATUS_SELECTED:
+        return
+    await outbox.send_message(context.bot, user.id, f"【课程即将开始】\n{course.name}")
+    course.status = Course.STATUS_FINISHED
+    user.repository.save(course)
+    on_course_status_changed(context.application, user, course.id, course.status)
+
+
+def on_course_status_changed(application, user: User, course_id, new_status):
+    key = user.storage_key('rush_priority')
+    priority = storage.get(key) or []
+    if new_status == Course.STATUS_BOOKED and course_id not in priority:
+        storage.set(key, priority + [course_id])
+    elif new_status != Course.STATUS_BOOKED and course_id in priority:
+        storage.set(key, [i for i in priority if i != course_id])
+    course = user.repository.get(course_id)
     if new_status == Course.STATUS_BOOKED:
-        with Session(engine) as session:
-            course = session.query(Course).filter(Course.id == course_id).scalar()
-            add_rush_job(application.job_queue, course.id, course.select_start_date)
+        add_rush_job(application.job_queue, user, course.id, course.select_start_date)
     if new_status == Course.STATUS_SELECTED:
-        with Session(engine) as session:
-            course = session.query(Course).filter(Course.id == course_id).scalar()
-            add_remind_job(application.job_queue, course.id, course.start_date)
+        add_remind_job(application.job_queue, user, course.id, course.start_date)
+    if new_status == Course.STATUS_WAITING:
+        schedule_waitlist(application.job_queue)  # the waitlist may be polling slowly as nothing was waiting
 
 
 ### main ###
 
 
 def init_handlers(application):
-    private_filter = filters.User(user_id=int(config.get('telegram_owner_id')))
+    private_filter = filters.User(user_id=users.ids())
+    owner_filter = filters.User(user_id=users.primary.id)  # the status is that of the whole bot
     start_handler = CommandHandler('start', start, filters=private_filter)
     query_avail_handler = CommandHandler('query_avail', query_avail, filters=private_filter)
     query_chosen_handler = CommandHandler('query_chosen', query_chosen, filters=private_filter)
+    status_handler = CommandHandler('status', status, filters=owner_filter)
+    page_handler = CallbackQueryHandler(page, pattern=r'^page \d+$')
+    refresh_list_handler = CallbackQueryHandler(refresh_list, pattern=r'^refresh_list$')
     detail_handler = CallbackQueryHandler(detail, pattern=r'^detail \d+$')
     choose_handler = CallbackQueryHandler(choose, pattern=r'^choose \d+ \w+$')
     cancel_handler = CallbackQueryHandler(cancel, pattern=r'^cancel \d+ \w+$')
@@ -572,6 +976,9 @@ def init_handlers(application):
     application.add_handler(start_handler)
     application.add_handler(query_avail_handler)
     application.add_handler(query_chosen_handler)
+    application.add_handler(status_handler)
+    application.add_handler(page_handler)
+    application.add_handler(refresh_list_handler)
     application.add_handler(detail_handler)
     application.add_handler(choose_handler)
     application.add_handler(cancel_handler)
@@ -579,26 +986,65 @@ def init_handlers(application):
 
 
 def init_jobs(application):
-    application.job_queue.run_repeating(refresh_course_list, 300, first=10, name='refresh')
-    application.job_queue.run_repeating(wait_for_others_cancellation, 30, first=10, name='wait_for_others_cancellation')
-
-    with Session(engine) as session:
-        courses = session.query(Course).filter(Course.status == Course.STATUS_BOOKED).all()
-        for course in courses:
-            add_rush_job(application.job_queue, course.id, course.select_start_date)
-
-        courses = session.query(Course).filter(Course.status == Course.STATUS_SELECTED).all()
-        for course in courses:
-            add_remind_job(application.job_queue, course.id, course.start_date)
+    schedule_poll(application.job_queue, poll_refresh, 'refresh', 10)
+    schedule_poll(application.job_queue, poll_waitlist, 'wait_for_others_cancellation', 10)
+    application.job_queue.run_repeating(keep_token_fresh, users.primary.token_manager.probe_interval, first=1,
+                                        name='keep_token_fresh')
+
+    for user in users:
+        for course in user.repository.with_status(Course.STATUS_BOOKED):
+            add_rush_job(application.job_queue, user, course.id, course.select_start_date)
+
+        for course in user.repository.with_status(Course.STATUS_SELECTED):
+            add_remind_job(application.job_queue, user, course.id, course.start_date)
+
+
+def init_metrics():
+    metrics.gauge('bykc_pool_requests_total', 'bykc requests by whether a pooled connection served them',
+                  lambda: {'hit': sum(user.client.pool_hits for user in users),
+                           'miss': sum(user.client.pool_misses for user in users)}, ('pool',), kind='counter')
+    metrics.gauge('bykc_clock_offset_seconds', 'estimated offset of the bykc server clock',
+                  lambda: users.primary.client.clock.offset)
+    metrics.gauge('bykc_clock_uncertainty_seconds', 'uncertainty of the clock offset',
+                  lambda: users.primary.client.clock.uncertainty)
+    metrics.gauge('token_age_seconds', 'age of the bykc token of each user',
+                  lambda: {str(user.id): user.token_manager.age() for user in users}, ('user',))
+    metrics.gauge('token_probes_total', 'probes of the bykc tokens',
+                  lambda: sum(user.token_manager.probes for user in users), kind='counter')
+    metrics.gauge('token_relogins_total', 'logins forced by the token manager',
+                  lambda: sum(user.token_manager.relogins for user in users), kind='counter')
+    metrics.gauge('detail_cache', 'entries and lookups of the course detail cache', course_cache.stats, ('stat',))
+    metrics.gauge('catalog_age_seconds', 'age of the catalog snapshot', catalog.age)
+    metrics.gauge('catalog_sync_courses', 'courses of the last refresh, by change', lambda: last_sync_counts,
+                  ('change',))
+    metrics.gauge('waitlist', 'polls, full courses skipped, attempts and selections of the waitlist',
+                  lambda: waitlist_stats, ('stat',), kind='counter')
+
+
+async def post_init(application):
+    if config.get('metrics_port'):
+        await metrics.serve(config.get('metrics_host') or '127.0.0.1', int(config.get('metrics_port')))
+
+
+async def post_shutdown(application):
+    await metrics.close()
+    await outbox.close()
+    await users.close()
+    await storage.flush()
+    offload.shutdown()
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    HANDLER_ERRORS.inc(error=type(context.error).__name__)
+    # the errors of a handler go to the user of the update, those of the jobs to the primary user
+    chat_id = users.primary.id
+    if isinstance(update, Update) and update.effective_user is not None and users.get(update.effective_user.id):
+        chat_id = update.effective_user.id
     if isinstance(context.error, ApiException):
-        await context.bot.send_message(config.get('telegram_owner_id'),
-                                       f"【与博雅服务器交互时发生错误】\n{context.error}")
+        await outbox.send_message(context.bot, chat_id, f"【与博雅服务器交互时发生错误】\n{context.error}",
+                                  PRIORITY_INTERACTIVE)
     elif not isinstance(context.error, TelegramError):
-        await context.bot.send_message(config.get('telegram_owner_id'),
-                                       f"【未知错误】\n{context.error}")
+        await outbox.send_message(context.bot, chat_id, f"【未知错误】\n{context.error}", PRIORITY_INTERACTIVE)
 
 
 if __name__ == '__main__':
@@ -611,10 +1057,13 @@ if __name__ == '__main__':
     application_builder.token(config.get('telegram_token'))
     if config.get('proxy_url'):
         application_builder.proxy_url(config.get('proxy_url'))
+    application_builder.post_init(post_init)
+    application_builder.post_shutdown(post_shutdown)
     application = application_builder.build()
 
     init_handlers(application)
     init_jobs(application)
+    init_metrics()
     application.add_error_handler(error_handler)
 
     application.run_polling()
@@ -0,0 +1,246 @@
+"""
+a small in-process metrics registry: counters, histograms and gauges read on collection.
+recording is a dict lookup and an addition, cheap enough to leave on during a rush.
+`/status` renders a summary, and `serve` exposes the same data in the prometheus text format
+"""
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+LabelValues = Tuple[str, ...]
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    """
+    the prometheus text format spells the special floats `+Inf`, `-Inf` and `NaN`
+    """
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return f'{value:g}'
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+    def summary(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        return super().render() + [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+                                   for key, value in self.values.items()]
+
+    def summary(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)}: {value:g}' for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: List[float] = None):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets or LATENCY_BUCKETS
+        self.values: Dict[LabelValues, list] = {}  # label values -> [counts per bucket and +Inf, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        data[0][bisect.bisect_left(self.buckets, value)] += 1
+        data[1] += value
+        data[2] += 1
+
+    def quantile(self, key: LabelValues, q: float) -> float:
+        """
+        the upper bound of the bucket holding the `q` quantile
+        """
+        counts, _, count = self.values[key]
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+    def summary(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)}: {count}次，平均{total / count:.3g}，'
+                f'p95≤{self.quantile(key, 0.95):g}'
+                for key, (counts, total, count) in self.values.items()]
+
+
+class Gauge(Metric):
+    """
+    read from `func` on collection, `func` returns a number, or a dict from label values to numbers
+    """
+
+    def __init__(self, name: str, help_text: str, func: Callable, labels: Tuple[str, ...] = (), kind='gauge'):
+        super().__init__(name, help_text, labels)
+        self.func = func
+        self.type = kind
+
+    def collect(self) -> Dict[LabelValues, float]:
+        try:
+            value = self.func()
+        except Exception:
+            logging.exception(f'failed to collect {self.name}')
+            return {}
+        if isinstance(value, dict):
+            return {key if isinstance(key, tuple) else (key,): v for key, v in value.items() if v is not None}
+        return {} if value is None else {(): value}
+
+    def render(self) -> List[str]:
+        return super().render() + [f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+                                   for key, value in self.collect().items()]
+
+    def summary(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)}: {value:g}' for key, value in self.collect().items()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.started_at = time.time()
+        self.server: Optional[asyncio.AbstractServer] = None  # of `serve`
+
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.metrics.get(name) or self._register(Counter(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (), buckets: List[float] = None) \
+            -> Histogram:
+        return self.metrics.get(name) or self._register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, func: Callable, labels: Tuple[str, ...] = (), kind='gauge') -> Gauge:
+        """
+        register a value read on collection, replacing the one registered with the same name
+        """
+        return self._register(Gauge(name, help_text, func, labels, kind))
+
+    def render(self) -> str:
+        """
+        the prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, prefix: str = '') -> List[str]:
+        lines = []
+        for name, metric in self.metrics.items():
+            if name.startswith(prefix):
+                lines += metric.summary()
+        return lines
+
+    def uptime(self) -> float:
+        return time.time() - self.started_at
+
+    def timed(self, histogram: Histogram, **labels):
+        """
+        decorator recording how long an async function runs, whether it returns or raises
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    async def serve(self, host: str, port: int) -> asyncio.AbstractServer:
+        """
+        serve `render` over http on every path
+        """
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                body = self.render().encode()
+                writer.write(b'HTTP/1.1 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                             b'Connection: close\r\n\r\n' + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        self.server = await asyncio.start_server(handle, host, port)
+        host, port = self.server.sockets[0].getsockname()[:2]
+        logging.info(f'metrics served on http://{host}:{port}/metrics')
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+metrics = Registry()
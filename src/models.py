@@ -1,12 +1,21 @@
 import datetime
 import os
+from typing import Optional, Tuple
 
 from sqlalchemy import String
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, Engine
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
 
+from config import config
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
 
 class Base(DeclarativeBase):
     pass
@@ -15,6 +24,7 @@ class Base(DeclarativeBase):
 class Course(Base):
     __tablename__ = "course"
     id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(primary_key=True)  # the telegram id of the user
     name: Mapped[str] = mapped_column(String(1023))
     start_date: Mapped[datetime.datetime]
     end_date: Mapped[datetime.datetime]
@@ -38,7 +48,55 @@ class Course(Base):
     # 4 ---> {}
 
 
-engine = create_engine("sqlite:///data/db.sqlite3", echo=False)
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers go on while writing, and with it `synchronous=NORMAL` only syncs at checkpoints
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+
+def create_engines(path: str, backend: str = None) -> Tuple[Engine, Optional[AsyncEngine]]:
+    """
+    :param backend: 'async' (needs aiosqlite) or 'sync'
+    :return: the sync engine, and the async engine or None if the sync backend is used
+    """
+    sync_engine = create_engine(f"sqlite:///{path}", echo=False)
+    event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    if backend == 'sync' or aiosqlite is None:
+        return sync_engine, None
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", echo=False)
+    event.listen(async_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return sync_engine, async_engine
+
 
-if not os.path.exists("data/db.sqlite3"):
+DB_PATH = config.get('db_path') or "data/db.sqlite3"
+
+engine, async_engine = create_engines(DB_PATH, config.get('db_backend'))
+
+if not os.path.exists(DB_PATH):
     Base.metadata.create_all(engine)
+
+
+def migrate(sync_engine: Engine, user_id: int):
+    """
+    a database created in the single user mode has no `user_id` column, its courses belong to `user_id`
+    """
+    if not inspect(sync_engine).has_table('course'):
+        Base.metadata.create_all(sync_engine)
+        return
+    columns = [column['name'] for column in inspect(sync_engine).get_columns('course')]
+    if 'user_id' in columns:
+        return
+    names = ', '.join(columns)
+    with sync_engine.begin() as connection:
+        connection.exec_driver_sql('ALTER TABLE course RENAME TO course_single_user')
+        connection.exec_driver_sql('DROP INDEX IF EXISTS ix_course_status')
+        Base.metadata.create_all(connection)
+        connection.exec_driver_sql(f'INSERT INTO course (user_id, {names}) SELECT ?, {names} FROM course_single_user',
+                                   (user_id,))
+        connection.exec_driver_sql('DROP TABLE course_single_user')
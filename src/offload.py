@@ -0,0 +1,55 @@
+"""
+run cpu heavy work (crypto, json, html parsing) off the event loop,
+so that telegram updates and rush attempts are not delayed by it
+"""
+import asyncio
+import concurrent.futures
+from typing import Optional
+
+from config import config
+
+
+class Offload:
+    """
+    `offload_threads`: size of the thread pool, 0 runs everything inline on the event loop
+    `offload_html_processes`: size of the process pool for html parsing, 0 parses html in the thread pool instead;
+    bs4 holds the GIL while parsing, so only a process pool really takes it off the loop
+    """
+
+    def __init__(self):
+        threads = config.get('offload_threads')
+        self.threads = 2 if threads is None or threads == '' else int(threads)
+        self.html_processes = int(config.get('offload_html_processes') or 0)
+        self._thread_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    async def run(self, func, *args):
+        """
+        run `func(*args)` in the thread pool
+        """
+        if self.threads <= 0:
+            return func(*args)
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix='offload')
+        return await asyncio.get_running_loop().run_in_executor(self._thread_pool, func, *args)
+
+    async def run_html(self, func, *args):
+        """
+        run `func(*args)` in the process pool, `func` and `args` must be picklable
+        """
+        if self.html_processes <= 0:
+            return await self.run(func, *args)
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(self.html_processes)
+        return await asyncio.get_running_loop().run_in_executor(self._process_pool, func, *args)
+
+    def shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+            self._thread_pool = None
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False)
+            self._process_pool = None
+
+
+offload = Offload()
@@ -0,0 +1,248 @@
+"""
+the outbound queue of every telegram bot api call.
+calls are sent by priority, within a global rate limit and a rate limit per chat, and retried after a flood wait
+"""
+import asyncio
+import collections
+import logging
+import statistics
+import time
+from typing import Deque, Dict, List, Optional
+
+from telegram.error import RetryAfter, BadRequest, NetworkError
+
+from config import config
+from metrics import metrics
+
+PRIORITY_URGENT = 0  # rush and waitlist results
+PRIORITY_INTERACTIVE = 1  # replies to the user
+PRIORITY_BULK = 2  # notifications of new courses, reminders
+PRIORITY_NAMES = {PRIORITY_URGENT: 'urgent', PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+SEND_LATENCY = metrics.histogram('telegram_send_latency_seconds', 'time from queued to sent of the telegram calls',
+                                 ('priority',))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0  # set by a flood wait
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self, now: float) -> float:
+        """
+        :return: seconds until a token can be taken
+        """
+        self._refill(now)
+        return max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.0)
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundCall:
+    def __init__(self, chat_id: Optional[int], priority: int, func, args, kwargs):
+        self.chat_id = chat_id
+        self.priority = priority
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = time.monotonic()
+        self.retries = 0
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class Outbox:
+    """
+    usage: `message = await outbox.call(chat_id, PRIORITY_INTERACTIVE, update.message.reply_text, text)`,
+    or `outbox.post(...)` without waiting for the result.
+    calls to the same chat are sent one by one in order, `chat_id` None only counts against the global limit,
+    e.g. answering a callback query, which is not a message
+    """
+    max_retries = 3  # on network errors
+
+    def __init__(self):
+        self.global_rate = float(config.get('outbox_global_rate') or 25)
+        self.chat_rate = float(config.get('outbox_chat_rate') or 1)
+        self.chat_burst = float(config.get('outbox_chat_burst') or 3)
+        self.max_inflight = 8
+        self._lanes: Dict[int, Deque[OutboundCall]] = {
+            priority: collections.deque() for priority in [PRIORITY_URGENT, PRIORITY_INTERACTIVE, PRIORITY_BULK]
+        }
+        self._global = TokenBucket(self.global_rate, self.global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._busy_chats = set()  # chats with a call in flight
+        self._inflight = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self._latencies: Deque[float] = collections.deque(maxlen=500)  # seconds from queued to sent
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._chats[chat_id]
+
+    def post(self, chat_id: Optional[int], priority: int, func, *args, **kwargs) -> asyncio.Future:
+        """
+        queue `func(*args, **kwargs)`, a coroutine function of the bot api
+        """
+        if chat_id is not None:
+            chat_id = int(chat_id)  # the owner id from the config may be a string
+        item = OutboundCall(chat_id, priority, func, args, kwargs)
+        item.future.add_done_callback(self._log_failure)
+        self._lanes[priority].append(item)
+        self._wake()
+        return item.future
+
+    async def call(self, chat_id: Optional[int], priority: int, func, *args, **kwargs):
+        """
+        queue the call and wait for its result
+        """
+        return await self.post(chat_id, priority, func, *args, **kwargs)
+
+    async def send_message(self, bot, chat_id: int, text: str, priority: int = PRIORITY_BULK, **kwargs):
+        return await self.call(chat_id, priority, bot.send_message, chat_id, text, **kwargs)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f'outbound telegram call failed: {future.exception()!r}')
+
+    def _wake(self):
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+        self._wakeup.set()
+
+    def _pick(self, now: float):
+        """
+        :return: the first call, by priority, that may be sent now, and otherwise how long to wait for one
+        """
+        wait = None
+        global_wait = self._global.ready_in(now)
+        for lane in self._lanes.values():
+            for item in lane:
+                if item.chat_id is None:
+                    item_wait = global_wait
+                elif item.chat_id in self._busy_chats:
+                    continue  # woken up when the call in flight is done
+                else:
+                    item_wait = max(global_wait, self._chat_bucket(item.chat_id).ready_in(now))
+                if item_wait <= 0:
+                    lane.remove(item)
+                    return item, 0
+                wait = item_wait if wait is None else min(wait, item_wait)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            item, wait = (None, None) if self._inflight >= self.max_inflight else self._pick(time.monotonic())
+            if item is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            self._global.take(now)
+            if item.chat_id is not None:
+                self._chat_bucket(item.chat_id).take(now)
+                self._busy_chats.add(item.chat_id)
+            self._inflight += 1
+            asyncio.create_task(self._send(item))
+
+    async def _send(self, item: OutboundCall):
+        try:
+            result = await item.func(*item.args, **item.kwargs)
+        except RetryAfter as e:
+            self.flood_waits += 1
+            logging.warning(f'flood wait of {e.retry_after}s on chat {item.chat_id}')
+            bucket = self._global if item.chat_id is None else self._chat_bucket(item.chat_id)
+            bucket.paused_until = time.monotonic() + e.retry_after
+            self._lanes[item.priority].appendleft(item)
+        except BadRequest as e:
+            self.failed += 1
+            self._settle(item, exception=e)
+        except NetworkError as e:
+            # a timed out message may have been delivered, but a duplicate beats a lost rush result
+            if item.retries < self.max_retries:
+                item.retries += 1
+                self._lanes[item.priority].appendleft(item)
+            else:
+                self.failed += 1
+                self._settle(item, exception=e)
+        except Exception as e:
+            self.failed += 1
+            self._settle(item, exception=e)
+        else:
+            self.sent += 1
+            latency = time.monotonic() - item.queued
+            self._latencies.append(latency)
+            SEND_LATENCY.observe(latency, priority=PRIORITY_NAMES[item.priority])
+            self._settle(item, result)
+        finally:
+            self._inflight -= 1
+            self._busy_chats.discard(item.chat_id)
+            self._wakeup.set()
+
+    @staticmethod
+    def _settle(item: OutboundCall, result=None, exception: Exception = None):
+        if item.future.done():  # the caller has given up
+            return
+        if exception is not None:
+            item.future.set_exception(exception)
+        else:
+            item.future.set_result(result)
+
+    def depth(self) -> Dict[int, int]:
+        return {priority: len(lane) for priority, lane in self._lanes.items()}
+
+    def stats(self) -> dict:
+        latencies: List[float] = sorted(self._latencies)
+        p50 = p95 = None
+        if latencies:
+            p50 = statistics.median(latencies)
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        return {
+            'depth': self.depth(),
+            'inflight': self._inflight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'latency_p50': p50,
+            'latency_p95': p95,
+        }
+
+    async def close(self, timeout: float = 5):
+        """
+        give the queued calls a few seconds to be sent, then drop the rest
+        """
+        deadline = time.monotonic() + timeout
+        while (any(self._lanes.values()) or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for lane in self._lanes.values():
+            for item in lane:
+                item.future.cancel()
+            lane.clear()
+        if self._worker is not None:
+            self._worker.cancel()
+
+
+outbox = Outbox()
+metrics.gauge('telegram_queue_depth', 'telegram calls waiting in the outbox',
+              lambda: {PRIORITY_NAMES[priority]: depth for priority, depth in outbox.depth().items()}, ('priority',))
+metrics.gauge('telegram_send_failures_total', 'telegram calls failed after retries', lambda: outbox.failed,
+              kind='counter')
+metrics.gauge('telegram_flood_waits_total', 'flood waits asked by telegram', lambda: outbox.flood_waits,
+              kind='counter')
@@ -0,0 +1,51 @@
+"""
+when to poll next: the refresh and waitlist jobs poll densely when something is about to happen
+on the course timeline, and back off when nothing is
+"""
+import datetime
+from typing import Iterable, List
+
+from config import config
+from models import Course
+
+
+def clamp(value: float, low: float, high: float) -> float:
+    return max(low, min(high, value))
+
+
+class PollingPolicy:
+    """
+    the refresh job polls every `refresh_max` seconds when no course opens for selection soon,
+    and more and more often as the next opening gets closer, down to `refresh_min`.
+    the waitlist job polls every `waitlist_interval` seconds while courses are waiting,
+    more often as the nearest cancel deadline gets closer since seats are freed right before it,
+    down to `waitlist_min`, and every `waitlist_max` seconds when no course is waiting
+    """
+    refresh_divisor = 10  # poll 10 times in the time left before the next opening
+    waitlist_divisor = 60  # poll 60 times in the time left before the nearest cancel deadline
+
+    def __init__(self):
+        self.refresh_min = float(config.get('refresh_min_interval') or 60)
+        self.refresh_max = float(config.get('refresh_max_interval') or 600)
+        self.waitlist_min = float(config.get('waitlist_min_interval') or 5)
+        self.waitlist_interval = float(config.get('waitlist_interval') or 30)
+        self.waitlist_max = float(config.get('waitlist_max_interval') or 120)
+
+    def refresh_delay(self, courses: Iterable[Course], now: datetime.datetime) -> float:
+        openings = [course.select_start_date for course in courses
+                    if course.status != Course.STATUS_FINISHED and course.select_start_date
+                    and course.select_start_date > now]
+        if not openings:
+            return self.refresh_max
+        left = (min(openings) - now).total_seconds()
+        return clamp(left / self.refresh_divisor, self.refresh_min, self.refresh_max)
+
+    def waitlist_delay(self, waiting: List[Course], now: datetime.datetime) -> float:
+        if not waiting:
+            return self.waitlist_max
+        deadlines = [course.cancel_end_date for course in waiting
+                     if course.cancel_end_date and course.cancel_end_date > now]
+        if not deadlines:
+            return self.waitlist_interval
+        left = (min(deadlines) - now).total_seconds()
+        return clamp(left / self.waitlist_divisor, self.waitlist_min, self.waitlist_interval)
@@ -0,0 +1,138 @@
+"""
+in-memory course repository of a user.
+reads never touch the disk, changes are written back to the database asynchronously and coalesced
+"""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select, Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from config import config
+from models import Course, engine, async_engine
+from offload import offload
+
+COLUMNS = [column.name for column in Course.__table__.columns]
+
+
+class CourseRepository:
+    """
+    holds every `Course` of a user detached from any session, indexed by id and by status.
+    mutate a course and call `save` to have it written back
+    """
+
+    def __init__(self, user_id: int, engines: Tuple[Engine, Optional[AsyncEngine]] = None):
+        """
+        :param user_id: the telegram id of the user
+        :param engines: the sync and the async engine as returned by `create_engines`, those of `models` by default
+        """
+        self.user_id = user_id
+        self._engine, self._async_engine = engines or (engine, async_engine)
+        self.write_delay = float(config.get('db_write_delay') or 1)
+        self._courses: Dict[int, Course] = {}
+        self._by_status: Dict[int, Set[int]] = defaultdict(set)
+        self._indexed_status: Dict[int, int] = {}
+        self._dirty: Set[int] = set()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_lock = asyncio.Lock()  # keep the writes in order
+        self._load()
+
+    def _load(self):
+        with Session(self._engine) as session:
+            courses = session.execute(select(Course).where(Course.user_id == self.user_id)).scalars().all()
+            session.expunge_all()
+        for course in courses:
+            self._courses[course.id] = course
+            self._index(course)
+
+    def _index(self, course: Course):
+        old_status = self._indexed_status.get(course.id)
+        if old_status == course.status:
+            return
+        if old_status is not None:
+            self._by_status[old_status].discard(course.id)
+        self._by_status[course.status].add(course.id)
+        self._indexed_status[course.id] = course.status
+
+    def get(self, course_id: int) -> Optional[Course]:
+        return self._courses.get(course_id)
+
+    def get_many(self, course_ids) -> Dict[int, Course]:
+        return {course_id: self._courses[course_id] for course_id in course_ids if course_id in self._courses}
+
+    def all(self) -> List[Course]:
+        return list(self._courses.values())
+
+    def with_status(self, status: int) -> List[Course]:
+        return [self._courses[course_id] for course_id in self._by_status[status]]
+
+    def add(self, course: Course):
+        course.user_id = self.user_id
+        self._courses[course.id] = course
+        self.save(course)
+
+    def save(self, course: Course):
+        """
+        re-index the course and schedule writing it back
+        """
+        self._index(course)
+        self._dirty.add(course.id)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._take_dirty_rows())  # no event loop, e.g. in a script
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.write_delay, lambda: loop.create_task(self.flush()))
+
+    def _take_dirty_rows(self) -> List[dict]:
+        rows = [{column: getattr(self._courses[course_id], column) for column in COLUMNS}
+                for course_id in self._dirty]
+        self._dirty.clear()
+        return rows
+
+    async def flush(self):
+        """
+        write all the pending changes in one transaction, through the async engine if there is one,
+        otherwise through the sync engine in the offload thread pool
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        rows = self._take_dirty_rows()
+        if not rows:
+            return
+        try:
+            if self._async_engine is not None:
+                async with self._async_engine.begin() as connection:
+                    await connection.execute(self._upsert(), rows)
+            else:
+                await offload.run(self._write, rows)
+        except Exception:
+            logging.exception('failed to write courses back, will retry')
+            for row in rows:
+                self._dirty.add(row['id'])
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.write_delay, lambda: loop.create_task(self.flush()))
+
+    @staticmethod
+    def _upsert():
+        stmt = insert(Course)
+        return stmt.on_conflict_do_update(index_elements=['id', 'user_id'],
+                                          set_={column: stmt.excluded[column] for column in COLUMNS
+                                                if column not in ['id', 'user_id']})
+
+    def _write(self, rows: List[dict]):
+        if not rows:
+            return
+        with self._engine.begin() as connection:
+            connection.execute(CourseRepository._upsert(), rows)
+
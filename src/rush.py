@@ -0,0 +1,256 @@
+"""
+the rush engine: runs one plan for all the courses that open at the same instant.
+it keeps a bounded number of choseCourse attempts in flight, adapted to how fast the server answers,
+sends them densely around the opening instant, and shares one attempt budget between the courses by priority
+"""
+import asyncio
+import collections
+import logging
+import math
+import time
+from typing import Dict, List, Optional
+
+from client import Client, AlreadyChosen, CourseIsFull, UnknownError, LoginExpired, LoginError
+from config import config
+from metrics import metrics
+
+RUSH_ATTEMPTS = metrics.counter('rush_attempts_total', 'choseCourse attempts of the rushes, by outcome', ('outcome',))
+RUSH_ATTEMPT_LATENCY = metrics.histogram('rush_attempt_latency_seconds', 'latency of the answered rush attempts')
+RUSH_RESULTS = metrics.counter('rush_results_total', 'courses rushed, by result', ('result',))
+
+# outcomes that are no answer of the selection, e.g. a 502 or a network error: they tell nothing about the latency
+FAILED_OUTCOMES = {UnknownError.__name__, LoginExpired.__name__, LoginError.__name__}
+
+
+class Attempt:
+    """
+    one choseCourse request of a rush
+    """
+
+    def __init__(self, course_id: int, sent: float):
+        self.course_id = course_id
+        self.sent = sent
+        self.answered: Optional[float] = None
+        self.outcome: Optional[str] = None
+
+    @property
+    def latency(self) -> Optional[float]:
+        return None if self.answered is None else self.answered - self.sent
+
+    def to_dict(self) -> dict:
+        return {'course_id': self.course_id, 'sent': self.sent, 'answered': self.answered, 'outcome': self.outcome}
+
+
+class RushEngine:
+    """
+    usage: `results = await RushEngine(client, course_ids, open_at).run()`
+    `results` maps every course id to None if the course is selected, or to `CourseIsFull` / `TimeoutError`
+    """
+
+    def __init__(self, client: Client, course_ids: List[int], open_at: float):
+        """
+        :param course_ids: the courses opening at `open_at`, in the order of priority
+        :param open_at: the server side unix timestamp when the courses open for selection
+        """
+        self.client = client
+        self.course_ids = list(course_ids)
+        self.open_at = open_at
+        self.timeout = float(config.get('rush_timeout') or 60)
+        self.retry_interval = float(config.get('rush_interval') or 0.5)
+        self.burst_interval = float(config.get('rush_burst_interval') or 0.05)
+        self.burst_seconds = float(config.get('rush_burst_seconds') or 2)
+        self.max_inflight = int(config.get('rush_max_inflight') or 8)
+        self.budget = int(config.get('rush_attempt_budget') or 300)
+        self.inline = config.get('rush_inline') is not False  # skip the executor, the envelopes are prebuilt
+        self.attempts: List[Attempt] = []
+        self.results: Dict[int, Optional[Exception]] = {}
+        self._remaining: List[int] = list(course_ids)  # courses not settled yet, in the order of priority
+        self._credits: Dict[int, int] = {course_id: 0 for course_id in course_ids}
+        self._inflight: Dict[asyncio.Task, int] = {}
+        self._latency: Optional[float] = None  # smoothed latency of answered attempts
+        self._finish: Optional[asyncio.Future] = None
+
+    def add_course(self, course_id: int) -> bool:
+        """
+        add a course to the plan with the lowest priority
+        :return: False if the plan has already finished
+        """
+        if self._finish is not None and self._finish.done():
+            return False
+        if course_id not in self.course_ids:
+            self.course_ids.append(course_id)
+            self._remaining.append(course_id)
+            self._credits[course_id] = 0
+        return True
+
+    def fire_at(self) -> float:
+        """
+        local timestamp at which an attempt reaches the server at the opening instant
+        """
+        return self.client.clock.fire_time(self.open_at)
+
+    def start_at(self) -> float:
+        """
+        the burst starts a little early to cover the error of the clock estimate,
+        attempts arriving too early only cost a TooEarlyToChoose
+        """
+        return self.fire_at() - min(self.client.clock.uncertainty, 1.0)
+
+    def interval(self, now: float) -> float:
+        if now < self.fire_at() + self.burst_seconds:
+            return self.burst_interval
+        return self.retry_interval
+
+    def window(self, now: float) -> int:
+        """
+        how many attempts may be in flight: enough to keep one attempt arriving every `interval`
+        """
+        latency = self._latency or self.client.clock.rtt or 0.1
+        return max(1, min(self.max_inflight, math.ceil(latency / self.interval(now))))
+
+    async def prepare(self):
+        """
+        right before the opening: open the connections, sample the clock once more and prebuild the envelopes
+        """
+        await self.client.warm_up()
+        await self.client.sync_clock()
+        for course_id in self.course_ids:
+            self.client.prepare_chose_course(course_id, int(config.get('envelope_pool_size') or 40))
+
+    def discard(self):
+        """
+        drop the envelopes left after the run
+        """
+        for course_id in self.course_ids:
+            self.client.discard_chose_course(course_id)
+
+    async def run(self) -> Dict[int, Optional[Exception]]:
+        self._finish = asyncio.get_running_loop().create_future()
+        now = time.time()
+        if now < self.start_at():
+            await asyncio.sleep(self.start_at() - now)
+        try:
+            await self._drive()
+        finally:
+            for task in self._inflight:
+                task.cancel()
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+            for course_id in self._remaining:
+                self.results[course_id] = TimeoutError()
+            self._remaining.clear()
+            for result in self.results.values():
+                RUSH_RESULTS.inc(result='selected' if result is None else type(result).__name__)
+        return self.results
+
+    async def _drive(self):
+        deadline = self.fire_at() + self.timeout
+        next_at = time.time()
+        while not self._finish.done():
+            now = time.time()
+            if now >= deadline:
+                break
+            if len(self.attempts) >= self.budget:
+                if not self._inflight:
+                    break
+                # the budget is spent, wait for the answers of the attempts in flight
+                await asyncio.wait({self._finish, *self._inflight}, timeout=max(0.0, deadline - now),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+            if now >= next_at and len(self._inflight) < self.window(now):
+                self._launch(now)
+                next_at = now + self.interval(now)
+            if len(self._inflight) >= self.window(now):
+                # wake up as soon as a slot is freed
+                aws = {self._finish, *self._inflight}
+                until = deadline
+            else:
+                aws = {self._finish}
+                until = min(next_at, deadline)
+            await asyncio.wait(aws, timeout=max(0.0, until - time.time()), return_when=asyncio.FIRST_COMPLETED)
+
+    def _next_course(self) -> int:
+        """
+        smooth weighted round robin over the remaining courses, the course with higher priority gets more attempts
+        """
+        total = 0
+        best = None
+        for rank, course_id in enumerate(self._remaining):
+            weight = len(self._remaining) - rank
+            self._credits[course_id] += weight
+            total += weight
+            if best is None or self._credits[course_id] > self._credits[best]:
+                best = course_id
+        self._credits[best] -= total
+        return best
+
+    def _launch(self, now: float):
+        attempt = Attempt(self._next_course(), now)
+        self.attempts.append(attempt)
+        task = asyncio.create_task(self._attempt(attempt))
+        self._inflight[task] = attempt.course_id
+        task.add_done_callback(lambda t: self._inflight.pop(t, None))
+
+    async def _attempt(self, attempt: Attempt):
+        try:
+            await self.client.chose_course(attempt.course_id, self.inline, retry=False)
+            attempt.outcome = 'selected'
+            self._settle(attempt.course_id)
+        except AlreadyChosen:
+            attempt.outcome = 'already_chosen'
+            self._settle(attempt.course_id)
+        except CourseIsFull as e:
+            attempt.outcome = 'full'
+            self._settle(attempt.course_id, e)
+        except asyncio.CancelledError:
+            attempt.outcome = 'cancelled'
+            raise
+        except Exception as e:
+            attempt.outcome = type(e).__name__
+        finally:
+            RUSH_ATTEMPTS.inc(outcome=attempt.outcome)
+            if attempt.outcome != 'cancelled':
+                attempt.answered = time.time()
+                latency = attempt.latency
+                RUSH_ATTEMPT_LATENCY.observe(latency)
+                if attempt.outcome not in FAILED_OUTCOMES:
+                    self._latency = latency if self._latency is None else self._latency * 0.7 + latency * 0.3
+
+    def _settle(self, course_id: int, exception: Exception = None):
+        """
+        record the result of a course and move its share of attempts to the remaining courses
+        """
+        if course_id not in self._remaining:
+            return
+        self._remaining.remove(course_id)
+        self.results[course_id] = exception
+        for task, inflight_course_id in list(self._inflight.items()):
+            if inflight_course_id == course_id and task is not asyncio.current_task():
+                task.cancel()
+        if not self._remaining and not self._finish.done():
+            self._finish.set_result(True)
+
+    def timeline(self) -> List[dict]:
+        """
+        per attempt timeline, timestamps are relative to the instant an attempt should be sent to arrive on opening
+        """
+        fire_at = self.fire_at()
+        return [{**a.to_dict(), 'sent': a.sent - fire_at, 'answered': a.answered and a.answered - fire_at}
+                for a in self.attempts]
+
+    def summary(self, course_id: int = None) -> str:
+        attempts = [a for a in self.attempts if course_id is None or a.course_id == course_id]
+        outcomes = collections.Counter(a.outcome for a in attempts)
+        answered = [a for a in attempts if a.answered is not None]
+        text = f'attempts {len(attempts)}, answered {len(answered)}'
+        if outcomes:
+            text += ' (' + ', '.join(f'{k}: {v}' for k, v in outcomes.most_common()) + ')'
+        won = [a for a in attempts if a.outcome in ['selected', 'already_chosen']]
+        if won:
+            text += f', seat after {won[0].answered - self.fire_at():.3f}s'
+        return text
+
+    def log_timeline(self):
+        for item in self.timeline():
+            answered = 'never' if item['answered'] is None else f"{item['answered']:+.3f}s"
+            logging.info(f"rush {item['course_id']}: sent {item['sent']:+.3f}s, "
+                         f"answered {answered}, outcome {item['outcome']}")
@@ -0,0 +1,93 @@
+"""
+end to end benchmark of the rush against `fake_bykc`, run with `python src/rush_bench.py`.
+every run logs in through the fake sso with a fresh `Client`, prepares and runs a `RushEngine` like the bot does,
+then reports the time to seat, the attempts sent and the success rate
+"""
+import argparse
+import asyncio
+import logging
+import math
+import os
+import statistics
+import tempfile
+import time
+
+from client import Client
+from config import config
+from fake_bykc import FakeBykc, FakeCourse
+from rush import RushEngine
+from storage import storage
+
+
+async def run_once(args, run: int) -> dict:
+    open_at = math.ceil(time.time() + args.skew + args.lead)
+    courses = [FakeCourse(100 + i, open_at, args.capacity, args.rivals, args.rival_spread)
+               for i in range(args.courses)]
+    server = FakeBykc(courses=courses, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                      skew=args.skew)
+    base_url = server.start()
+    config.override(bykc_root=base_url, sso_root=base_url + '/sso', bykc_rsa_public_key=server.public_key)
+    client = Client(server.username, server.password)
+    try:
+        await client.reauthenticate(soft=False)
+        rush = RushEngine(client, [course.id for course in courses], open_at)
+        await rush.prepare()
+        try:
+            results = await rush.run()
+        finally:
+            rush.discard()
+    finally:
+        await client.close()
+        server.stop()
+
+    seated = [course.chosen[client.token] - open_at for course in courses if client.token in course.chosen]
+    report = {
+        'run': run,
+        'seated': len(seated),
+        'courses': len(courses),
+        'time_to_seat': min(seated) if seated else None,  # server side, from the opening to the first seat
+        'attempts': len(rush.attempts),
+        'outcomes': dict(server.outcomes),
+        'clock_error': client.clock.offset - args.skew,
+        'results': {course_id: 'selected' if e is None else type(e).__name__ for course_id, e in results.items()},
+    }
+    seat = 'no seat' if report['time_to_seat'] is None else f"first seat {report['time_to_seat'] * 1000:+.0f}ms"
+    print(f"run {run}: {report['seated']}/{report['courses']} seated, {seat}, {report['attempts']} attempts "
+          f"{report['outcomes']}, clock error {report['clock_error'] * 1000:+.0f}ms")
+    return report
+
+
+async def bench(args):
+    reports = [await run_once(args, run) for run in range(1, args.runs + 1)]
+    seats = [r['time_to_seat'] for r in reports if r['time_to_seat'] is not None]
+    success = sum(r['seated'] for r in reports) / sum(r['courses'] for r in reports)
+    print(f"success rate {success:.0%}, attempts per run {statistics.mean(r['attempts'] for r in reports):.1f}")
+    if seats:
+        print(f"time to seat: mean {statistics.mean(seats) * 1000:.0f}ms, "
+              f"median {statistics.median(seats) * 1000:.0f}ms, max {max(seats) * 1000:.0f}ms")
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the rush against a local stand-in of bykc')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--courses', type=int, default=1, help='courses opening at the same instant')
+    parser.add_argument('--capacity', type=int, default=30)
+    parser.add_argument('--rivals', type=int, default=60, help='other students rushing each course')
+    parser.add_argument('--rival-spread', type=float, default=0.5, help='seconds over which the rivals arrive')
+    parser.add_argument('--latency', type=float, default=0.03, help='round trip time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--skew', type=float, default=0.3, help='server clock minus local clock in seconds')
+    parser.add_argument('--lead', type=float, default=6, help='seconds from the start of a run to the opening')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        storage.path = os.path.join(directory, 'storage.json')  # keep the tokens of the bot untouched
+        storage.data = {}
+        asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
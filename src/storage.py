@@ -1,27 +1,46 @@
+import asyncio
+import atexit
 import json
+import logging
 import os
+from typing import Optional
+
+from offload import offload
 
 
 class Storage:
     """
+    a small key-value storage persisted in a json file.
+    `set` only marks the data dirty, several sets in a row are written back by one flush;
+    the file is replaced atomically, so a crash leaves either the old or the new content
     """
     path = 'data/storage.json'
+    flush_delay = 1  # seconds
 
     def __init__(self):
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._dirty = False
+        self._flush_lock = asyncio.Lock()
         if not os.path.exists(self.path):
             self.data = {}
         else:
             self._load()
 
-    def _save(self):
-        with open(self.path, 'w') as f:
-            json.dump(self.data, f, indent=4)
+    def _save(self, data: dict = None):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data if data is None else data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
 
     def _load(self):
         with open(self.path, 'r') as f:
             try:
                 self.data = json.load(f)
             except json.decoder.JSONDecodeError:
+                logging.error(f'{self.path} is corrupted, starting with empty storage')
+                os.replace(self.path, self.path + '.corrupted')
                 self.data = {}
 
     def get(self, item):
@@ -29,7 +48,46 @@ class Storage:
 
     def set(self, key, value):
         self.data[key] = value
-        self._save()
+        self._dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now()  # no event loop, e.g. in a script
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_delay, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        """
+        write the data back in the offload thread pool
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = json.loads(json.dumps(self.data))  # a snapshot, `set` may be called while writing
+            try:
+                await offload.run(self._save, data)
+            except OSError:
+                logging.exception(f'failed to write {self.path}, will retry')
+                self._dirty = True
+                loop = asyncio.get_running_loop()
+                self._flush_handle = loop.call_later(self.flush_delay, lambda: loop.create_task(self.flush()))
+
+    def flush_now(self):
+        """
+        write the data back synchronously, used when there is no event loop, e.g. on exit
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._dirty:
+            self._dirty = False
+            self._save()
 
 
 storage = Storage()
+atexit.register(storage.flush_now)
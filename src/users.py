@@ -0,0 +1,130 @@
+"""
+the users of the bot. every user has their own bykc account, with its own client, token and connection pool,
+and their own course statuses. the catalog is the same for everyone, so it is fetched once and shared
+"""
+import asyncio
+import logging
+import time
+from typing import Dict, Iterator, List, Optional, Set
+
+from client import Client, TokenManager, ApiException
+from config import config
+from models import engine, async_engine, migrate
+from repository import CourseRepository
+
+
+class User:
+    """
+    a user of the bot, identified by their telegram id
+    """
+
+    def __init__(self, telegram_id: int, sso_username: str, sso_password: str, primary: bool = False):
+        """
+        :param primary: the shared catalog is fetched by the client of the primary user,
+        whose token is kept under the storage keys of the single user mode
+        """
+        self.id = telegram_id
+        self.primary = primary
+        self.client = Client(sso_username, sso_password, storage_prefix='' if primary else f'{sso_username}_')
+        self.token_manager = TokenManager(self.client)
+        self.repository = CourseRepository(telegram_id)
+        self.chosen_ids: Set[int] = set()  # the courses chosen by a user other than the primary one
+        self.chosen_synced_at: Optional[float] = None
+
+    def storage_key(self, name: str) -> str:
+        return self.client.storage_prefix + name
+
+    def is_chosen(self, course: dict) -> bool:
+        """
+        :param course: a course from the shared catalog or the course cache, whose `selected` is that of the primary user
+        """
+        if self.primary:
+            return course['selected']
+        return course['id'] in self.chosen_ids
+
+    def record_chosen(self, course_id: int, selected: bool):
+        if selected:
+            self.chosen_ids.add(course_id)
+        else:
+            self.chosen_ids.discard(course_id)
+
+    async def sync_chosen(self) -> List[dict]:
+        """
+        :return: the chosen courses of the current semester
+        """
+        resp = await self.client.query_chosen_course()
+        courses = [course['courseInfo'] for course in resp['courseList']]
+        self.chosen_ids = {course['id'] for course in courses}
+        self.chosen_synced_at = time.time()
+        return courses
+
+    def knows_chosen(self) -> bool:
+        """
+        whether `is_chosen` can be trusted, a course seems not chosen before the first sync
+        """
+        return self.primary or self.chosen_synced_at is not None
+
+    async def ensure_chosen(self):
+        if not self.knows_chosen():
+            await self.sync_chosen()
+
+
+class UserPool:
+    """
+    the users of the `users` config item, a list of objects with `telegram_id`, `sso_username` and `sso_password`,
+    the first of which is the primary user.
+    without it, the single user is made of `telegram_owner_id`, `sso_username` and `sso_password`
+    """
+
+    def __init__(self):
+        self.chosen_refresh_interval = float(config.get('chosen_refresh_interval') or 1800)
+        entries = config.get('users') or [{
+            'telegram_id': config.get('telegram_owner_id'),
+            'sso_username': config.get('sso_username'),
+            'sso_password': config.get('sso_password'),
+        }]
+        migrate(engine, int(entries[0]['telegram_id'] or 0))
+        self._users: Dict[int, User] = {}
+        for i, entry in enumerate(entries):
+            user = User(int(entry['telegram_id'] or 0), entry['sso_username'], entry['sso_password'], primary=i == 0)
+            self._users[user.id] = user
+
+    def __iter__(self) -> Iterator[User]:
+        return iter(self._users.values())
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    @property
+    def primary(self) -> User:
+        return next(iter(self._users.values()))
+
+    def get(self, telegram_id: int) -> Optional[User]:
+        return self._users.get(telegram_id)
+
+    def ids(self) -> List[int]:
+        return list(self._users)
+
+    async def sync_chosen(self):
+        """
+        refresh the chosen courses of the users other than the primary one, at most every `chosen_refresh_interval`
+        seconds: the shared catalog only tells which courses the primary user has chosen
+        """
+        now = time.time()
+        stale = [user for user in self if not user.primary and
+                 (user.chosen_synced_at is None or now - user.chosen_synced_at > self.chosen_refresh_interval)]
+        results = await asyncio.gather(*[user.sync_chosen() for user in stale], return_exceptions=True)
+        for user, result in zip(stale, results):
+            if isinstance(result, ApiException):
+                logging.warning(f'failed to sync the chosen courses of user {user.id}: {result!r}')
+            elif isinstance(result, Exception):
+                raise result
+
+    async def close(self):
+        await asyncio.gather(*[user.repository.flush() for user in self])
+        await asyncio.gather(*[user.client.close() for user in self])
+        if async_engine is not None:
+            await async_engine.dispose()
+
+
+users = UserPool()